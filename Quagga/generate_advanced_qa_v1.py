@@ -1,31 +1,23 @@
 import os
 import json
-import wikipedia
-import google.generativeai as genai
-from SPARQLWrapper import SPARQLWrapper, JSON
-from tqdm import tqdm
 import logging
 from typing import List, Dict, Any, Optional
 
+# wikipedia, google.generativeai, SPARQLWrapper and tqdm are imported where they are used.
+
 # --- Configuration ---
 # IMPORTANT: Set your Google API key as an environment variable
 # export GEMINI_API_KEY='YOUR_API_KEY'
-try:
-    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-except KeyError:
-    print("ERROR: GEMINI_API_KEY environment variable not set.")
-    exit()
+# (read in main(), so importing this module has no side effects)
 
 ARCO_SPARQL_ENDPOINT = "https://dati.beniculturali.it/sparql"
 DBPEDIA_SPARQL_ENDPOINT = "http://dbpedia.org/sparql"
 USER_AGENT = "AdvancedQAGen/0.1 (Educational Script)"
 
-# --- Setup Logging ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
 # --- SPARQL Management ---
 def execute_sparql_query(endpoint: str, query: str) -> Optional[List[Dict[str, Any]]]:
     """Executes a SPARQL query against a given endpoint."""
+    from SPARQLWrapper import SPARQLWrapper, JSON
     try:
         sparql = SPARQLWrapper(endpoint)
         sparql.setReturnFormat(JSON)
@@ -42,6 +34,7 @@ def execute_sparql_query(endpoint: str, query: str) -> Optional[List[Dict[str, A
 
 def get_wikipedia_summary(entity_label: str) -> Optional[str]:
     """Fetches the summary of a Wikipedia page."""
+    import wikipedia
     try:
         # auto_suggest=False is more reliable for exact matches
         summary = wikipedia.summary(entity_label, sentences=5, auto_suggest=False)
@@ -141,6 +134,7 @@ def generate_qa_pairs_with_gemini(entity_label: str, wiki_summary: str, arco_sch
     **Generated Output:**
     """
     
+    import google.generativeai as genai
     try:
         model = genai.GenerativeModel('gemini-2.5-flash-lite')
         response = model.generate_content(prompt)
@@ -156,6 +150,15 @@ def generate_qa_pairs_with_gemini(entity_label: str, wiki_summary: str, arco_sch
 
 def main():
     """Main execution function to run the demonstration."""
+    # --- Setup Logging ---
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    import google.generativeai as genai
+    from tqdm import tqdm
+    try:
+        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+    except KeyError:
+        print("ERROR: GEMINI_API_KEY environment variable not set.")
+        exit()
     
     # --- Define our example entities ---
     # We provide the ArCo URI and the label to search on Wikipedia
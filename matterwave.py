@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Single entry point for the MatterWave data pipelines.
+
+Subcommands:
+  discover   Crawl DBpedia categories for entity URIs (tests/discover_entities.py)
+  generate   Build the triplet dataset in Iceberg (tests/generate_dataset_from_uris.py)
+  validate   Run the vectorized quality checks (tests/validate_dataset.py)
+  evaluate   Retrieval, prototype and calibration metrics over embeddings (tests/evaluate_embeddings.py)
+  qa         Generate verified ArCo question/SPARQL pairs (Quagga/generate_advanced_qa.py)
+
+Usage:
+  python matterwave.py discover --category "Physics" --depth 1 --output physics_entities.jsonl
+  python matterwave.py generate --input physics_entities.jsonl --num-shards 4 --shard-index 0 --run-id crawl-01
+  python matterwave.py validate --lang de --report quality.json
+  python matterwave.py evaluate --input eval_embeddings.pkl --hops hop_counts.pkl --workers 8
+  python matterwave.py qa --input entities.jsonl
+
+Everything after the subcommand is passed to that script's own `main`, so
+`python matterwave.py generate --help` lists the generator's options. Only the
+selected script is imported, and the scripts load heavy dependencies (pyarrow,
+pyiceberg, Gemini) inside the stages that use them, so a job pays only for
+what it runs.
+"""
+import sys
+import importlib
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+# subcommand -> (directory, module, summary)
+COMMANDS = {
+    "discover": ("tests", "discover_entities", "Crawl DBpedia categories for entity URIs."),
+    "generate": ("tests", "generate_dataset_from_uris", "Build the triplet dataset in Iceberg."),
+    "validate": ("tests", "validate_dataset", "Run the vectorized quality checks over the dataset."),
+    "evaluate": ("tests", "evaluate_embeddings", "Compute recall@k, prototype, hop-distance and calibration metrics."),
+    "qa": ("Quagga", "generate_advanced_qa", "Generate verified ArCo question/SPARQL pairs."),
+}
+
+
+def print_usage(out=sys.stdout):
+    print("usage: matterwave.py {" + ",".join(COMMANDS) + "} [options]\n", file=out)
+    for name, (_, _, summary) in COMMANDS.items():
+        print(f"  {name:<10} {summary}", file=out)
+    print("\nRun 'matterwave.py <command> --help' for the options of a command.", file=out)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ("-h", "--help"):
+        print_usage()
+        return 0
+    if argv[0] not in COMMANDS:
+        print(f"matterwave.py: unknown command '{argv[0]}'\n", file=sys.stderr)
+        print_usage(sys.stderr)
+        return 2
+
+    directory, module_name, _ = COMMANDS[argv[0]]
+    # The scripts import their siblings (stage_profiler, training_columns) by plain module name
+    sys.path.insert(0, str(ROOT / directory))
+    sys.argv = [f"matterwave.py {argv[0]}", *argv[1:]]  # so the script's --help shows the subcommand
+    module = importlib.import_module(module_name)
+    return module.main(argv[1:])
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -8,89 +8,295 @@ Behavior:
 - Uses the existing exporter `export_to_pptx.py` to write a PPTX (timestamped).
 - Tries PowerPoint COM automation (via pywin32) to export PDF on Windows.
 - Falls back to LibreOffice (`soffice`) headless conversion if COM is unavailable.
+- Hashes each slide's Markdown and records it in `reports/.deck_hashes.json`;
+  a deck whose slides are unchanged since its last build is skipped.
+- Converts several decks (`--decks`) or rebuilds decks as they change
+  (`--watch`) through a single converter process that stays alive between
+  jobs, so PowerPoint / LibreOffice start-up is paid once.
 
 Usage:
   python generate_presentation.py
+  python generate_presentation.py --decks Deck.md other/Review.md
+  python generate_presentation.py --watch --interval 2
 
 Requirements (optional paths):
 - python-pptx (for the PPTX exporter) — required by export_to_pptx.py
 - pywin32 (win32com) if you want COM-based PDF export on Windows
-- LibreOffice (`soffice`) as an alternate PDF converter
+- LibreOffice (`soffice`) as an alternate PDF converter; with its Python UNO
+  bindings (`uno`) importable, one headless instance is reused for all jobs
 
 The script will print the produced file paths on success.
 """
 from pathlib import Path
 from datetime import datetime
+import argparse
+import hashlib
+import json
+import os
+import shutil
 import sys
 import subprocess
+import tempfile
+import time
 
 
-def main():
+def slide_hashes(deck_md: Path):
+    """Returns the SHA-256 of each slide's Markdown, using the exporter's own slide splitting."""
+    import export_to_pptx
+    md = deck_md.read_text(encoding='utf-8')
+    return [hashlib.sha256(s.encode('utf-8')).hexdigest() for s in export_to_pptx.split_slides(md)]
+
+
+def load_hash_cache(cache_path: Path):
+    if cache_path.exists():
+        try:
+            return json.loads(cache_path.read_text(encoding='utf-8'))
+        except ValueError:
+            pass
+    return {}
+
+
+def save_hash_cache(cache_path: Path, cache):
+    cache_path.write_text(json.dumps(cache, indent=2), encoding='utf-8')
+
+
+def deck_is_current(deck_md: Path, cache, hashes=None):
+    """True if the deck's slides match its last build and that build's PDF still exists."""
+    entry = cache.get(str(deck_md.resolve()), {})
+    if hashes is None:
+        hashes = slide_hashes(deck_md)
+    return entry.get('slides') == hashes and Path(entry.get('pdf') or '').is_file()
+
+
+class PowerPointConverter:
+    """Keeps one PowerPoint.Application open for every conversion (Windows + pywin32)."""
+    name = 'PowerPoint'
+
+    def __init__(self):
+        import win32com.client
+        self.app = win32com.client.Dispatch('PowerPoint.Application')
+        self.app.Visible = 1
+
+    def convert(self, pptx_path: Path, pdf_path: Path):
+        pres = self.app.Presentations.Open(str(pptx_path), False, False, False)
+        try:
+            pres.SaveAs(str(pdf_path), 32)  # 32 = PDF
+        finally:
+            pres.Close()
+
+    def close(self):
+        self.app.Quit()
+
+
+class LibreOfficeUnoConverter:
+    """Starts one headless `soffice` listening on a pipe and feeds it jobs over UNO."""
+    name = 'LibreOffice (warm)'
+
+    def __init__(self, startup_timeout=30):
+        import uno
+        self.uno = uno
+        self.profile_dir = tempfile.mkdtemp(prefix='soffice-profile-')
+        pipe = f'matterwave_{os.getpid()}'
+        # A private profile keeps this instance from attaching to a user's running LibreOffice
+        self.proc = subprocess.Popen([
+            'soffice', '--headless', '--norestore', '--nologo', '--nodefault',
+            f'-env:UserInstallation={Path(self.profile_dir).as_uri()}',
+            f'--accept=pipe,name={pipe};urp;',
+        ])
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext('com.sun.star.bridge.UnoUrlResolver', local)
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            try:
+                ctx = resolver.resolve(f'uno:pipe,name={pipe};urp;StarOffice.ComponentContext')
+                break
+            except Exception:
+                if time.monotonic() > deadline or self.proc.poll() is not None:
+                    self.proc.kill()
+                    raise RuntimeError('soffice did not accept UNO connections')
+                time.sleep(0.5)
+        self.desktop = ctx.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', ctx)
+
+    def _props(self, **kwargs):
+        from com.sun.star.beans import PropertyValue
+        props = []
+        for key, value in kwargs.items():
+            p = PropertyValue()
+            p.Name, p.Value = key, value
+            props.append(p)
+        return tuple(props)
+
+    def convert(self, pptx_path: Path, pdf_path: Path):
+        doc = self.desktop.loadComponentFromURL(self.uno.systemPathToFileUrl(str(pptx_path.resolve())), '_blank', 0, self._props(Hidden=True))
+        try:
+            doc.storeToURL(self.uno.systemPathToFileUrl(str(pdf_path.resolve())), self._props(FilterName='impress_pdf_Export'))
+        finally:
+            doc.close(True)
+
+    def close(self):
+        try:
+            self.desktop.terminate()
+        except Exception:
+            pass
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+
+class LibreOfficeCliConverter:
+    """Fallback without UNO bindings: one `soffice --convert-to` per call, but batches share it."""
+    name = 'LibreOffice'
+
+    def convert(self, pptx_path: Path, pdf_path: Path):
+        self.convert_many([(pptx_path, pdf_path)])
+
+    def convert_many(self, jobs):
+        by_dir = {}
+        for pptx_path, pdf_path in jobs:
+            by_dir.setdefault(pdf_path.parent, []).append((pptx_path, pdf_path))
+        for out_dir, dir_jobs in by_dir.items():
+            subprocess.run(['soffice', '--headless', '--convert-to', 'pdf', '--outdir', str(out_dir)]
+                           + [str(p) for p, _ in dir_jobs], check=True)
+            for pptx_path, pdf_path in dir_jobs:
+                # LibreOffice writes a PDF with the same base name as the PPTX
+                expected = out_dir / pptx_path.with_suffix('.pdf').name
+                if not expected.exists():
+                    raise RuntimeError(f'LibreOffice conversion ran but expected PDF not found: {expected}')
+                if expected != pdf_path:
+                    expected.rename(pdf_path)
+
+    def close(self):
+        pass
+
+
+def open_converter():
+    """Returns the first available converter: PowerPoint COM, warm LibreOffice, then LibreOffice CLI."""
+    for factory in (PowerPointConverter, LibreOfficeUnoConverter):
+        try:
+            converter = factory()
+            print('Using PDF converter:', converter.name)
+            return converter
+        except Exception as e:
+            print(f'{factory.name} converter unavailable:', e)
+    print('Using PDF converter: LibreOffice (soffice per batch)')
+    return LibreOfficeCliConverter()
+
+
+def build_pptx(deck_md: Path, reports_dir: Path, cache, force=False):
+    """Writes a timestamped PPTX for `deck_md` unless its slides are unchanged since the last build.
+
+    Returns the new PPTX path, or None when the deck is unchanged.
+    """
+    import export_to_pptx
+    key = str(deck_md.resolve())
+    hashes = slide_hashes(deck_md)
+    previous = cache.get(key, {})
+    if not force and deck_is_current(deck_md, cache, hashes):
+        print(f'{deck_md.name} unchanged; latest outputs:', previous['pdf'])
+        return None
+    old = previous.get('slides', [])
+    changed = [i + 1 for i, h in enumerate(hashes) if i >= len(old) or old[i] != h]
+    if old:
+        print(f'{deck_md.name}: {len(changed)} changed slide(s) {changed[:20]}, {len(hashes)} total')
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    pptx_path = reports_dir / f'{deck_md.stem}_{timestamp}.pptx'
+    export_to_pptx.make_pptx(deck_md, pptx_path)
+    print('Wrote PPTX:', pptx_path)
+    cache[key] = {'slides': hashes, 'pptx': str(pptx_path), 'pdf': None}
+    return pptx_path
+
+
+def build_decks(decks, converter, reports_dir: Path, cache_path: Path, force=False):
+    """Builds every changed deck, then converts all new PPTX files through `converter`. Returns an exit code."""
+    cache = load_hash_cache(cache_path)
+    jobs = []
+    for deck_md in decks:
+        try:
+            pptx_path = build_pptx(deck_md, reports_dir, cache, force)
+        except Exception as e:
+            print(f'Failed to create PPTX for {deck_md}:', e)
+            return 4
+        if pptx_path is not None:
+            jobs.append((deck_md, pptx_path, pptx_path.with_suffix('.pdf')))
+    save_hash_cache(cache_path, cache)
+    if not jobs:
+        return 0
+
+    try:
+        pairs = [(pptx_path, pdf_path) for _, pptx_path, pdf_path in jobs]
+        if hasattr(converter, 'convert_many'):
+            converter.convert_many(pairs)
+        else:
+            for pptx_path, pdf_path in pairs:
+                converter.convert(pptx_path, pdf_path)
+    except Exception as e:
+        print(f'{converter.name} PDF conversion failed:', e)
+        return 5
+    for deck_md, _, pdf_path in jobs:
+        cache[str(deck_md.resolve())]['pdf'] = str(pdf_path)
+        print(f'Wrote PDF via {converter.name}:', pdf_path)
+    save_hash_cache(cache_path, cache)
+    return 0
+
+
+def main(argv=None):
     repo_root = Path(__file__).resolve().parents[1]
     slides_dir = Path(__file__).resolve().parent
-    deck_md = slides_dir / 'Deck.md'
-    if not deck_md.exists():
-        print('Deck.md not found in slides/; aborting')
+
+    parser = argparse.ArgumentParser(description='Build timestamped PPTX/PDF reports from Markdown decks.')
+    parser.add_argument('--decks', nargs='+', type=Path, default=[slides_dir / 'Deck.md'], help='Markdown decks to build (default: slides/Deck.md).')
+    parser.add_argument('--watch', action='store_true', help='Keep running and rebuild decks whenever they change.')
+    parser.add_argument('--interval', type=float, default=2.0, help='Polling interval in seconds for --watch.')
+    parser.add_argument('--force', action='store_true', help='Rebuild even if no slide changed.')
+    args = parser.parse_args(argv)
+
+    missing = [d for d in args.decks if not d.exists()]
+    if missing:
+        print('Deck not found:', ', '.join(str(d) for d in missing), '; aborting')
         return 2
 
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     reports_dir = repo_root / 'reports'
     reports_dir.mkdir(parents=True, exist_ok=True)
-
-    pptx_name = f'Deck_{timestamp}.pptx'
-    pdf_name = f'Deck_{timestamp}.pdf'
-    pptx_path = reports_dir / pptx_name
-    pdf_path = reports_dir / pdf_name
+    cache_path = reports_dir / '.deck_hashes.json'
 
     # Import the local exporter (slides/export_to_pptx.py)
     sys.path.insert(0, str(slides_dir))
     try:
-        import export_to_pptx
+        import export_to_pptx  # noqa: F401
     except Exception as e:
         print('Failed to import export_to_pptx.py (install python-pptx?):', e)
         return 3
 
+    converter = None
     try:
-        export_to_pptx.make_pptx(deck_md, pptx_path)
-        print('Wrote PPTX:', pptx_path)
-    except Exception as e:
-        print('Failed to create PPTX:', e)
-        return 4
+        if not args.watch:
+            # Nothing to convert if every deck is unchanged; don't start a converter for it
+            cache = load_hash_cache(cache_path)
+            if not args.force and all(deck_is_current(d, cache) for d in args.decks):
+                for d in args.decks:
+                    print(f'{d.name} unchanged; latest outputs:', cache[str(d.resolve())]['pdf'])
+                return 0
+            converter = open_converter()
+            return build_decks(args.decks, converter, reports_dir, cache_path, args.force)
 
-    # Try PowerPoint COM automation (Windows + pywin32)
-    try:
-        import win32com.client
-        print('Attempting PDF export via PowerPoint COM...')
-        pp = win32com.client.Dispatch('PowerPoint.Application')
-        pp.Visible = 1
-        pres = pp.Presentations.Open(str(pptx_path), False, False, False)
-        pres.SaveAs(str(pdf_path), 32)  # 32 = PDF
-        pres.Close()
-        pp.Quit()
-        print('Wrote PDF via PowerPoint:', pdf_path)
+        converter = open_converter()
+        print(f'Watching {len(args.decks)} deck(s); press Ctrl+C to stop.')
+        mtimes = {}
+        while True:
+            changed = [d for d in args.decks if mtimes.get(d) != d.stat().st_mtime]
+            for d in changed:
+                mtimes[d] = d.stat().st_mtime
+            if changed:
+                build_decks(changed, converter, reports_dir, cache_path, args.force)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
         return 0
-    except Exception as e:
-        print('PowerPoint COM export unavailable or failed:', e)
-
-    # Fallback: try LibreOffice headless conversion
-    try:
-        print('Attempting PDF export via LibreOffice (soffice)...')
-        subprocess.run([
-            'soffice', '--headless', '--convert-to', 'pdf',
-            '--outdir', str(reports_dir), str(pptx_path)
-        ], check=True)
-        # LibreOffice will write a PDF with same base name into reports_dir
-        expected = reports_dir / pptx_path.with_suffix('.pdf').name
-        if expected.exists():
-            expected.rename(pdf_path)
-            print('Wrote PDF via LibreOffice:', pdf_path)
-            return 0
-        else:
-            print('LibreOffice conversion ran but expected PDF not found:', expected)
-            return 6
-    except Exception as e:
-        print('LibreOffice conversion failed or soffice not found:', e)
-        return 5
+    finally:
+        if converter is not None:
+            converter.close()
 
 
 if __name__ == '__main__':
@@ -1,23 +1,263 @@
 
+import os
+import re
+import sys
 import json
+import time
+import shutil
 import argparse
-from SPARQLWrapper import SPARQLWrapper, JSON
-from tqdm import tqdm
+from array import array
+
+# SPARQLWrapper and tqdm are imported where they are used, so `--help` does not pay for loading them.
 
 # --- Configuration ---
 CONFIG = {
     "sparql_endpoint": "https://dbpedia.org/sparql",
     "user_agent": "KGEntityDiscoverer/1.0 (YourEmail@YourDomain.com)",
+    # Rows per page. Must not exceed the endpoint's result cap (10000 on dbpedia.org), otherwise a
+    # capped page looks like the last one.
+    "page_size": 10000,
+    # Categories with more articles than this are streamed without being recorded in the snapshot,
+    # so a huge category is never held in memory as a whole.
+    "snapshot_max_articles": 200000,
 }
 
+
+def _parse_tsv_term(term: str) -> str:
+    """Strips SPARQL TSV term syntax (<iri> or "literal"@lang) down to the plain value."""
+    if term.startswith("<") and term.endswith(">"):
+        term = term[1:-1]
+    elif term.startswith('"'):
+        term = term[1:term.rindex('"')] if term.count('"') > 1 else term[1:]
+    if "\\u" in term:
+        term = re.sub(r"\\u([0-9A-Fa-f]{4})", lambda m: chr(int(m.group(1), 16)), term)
+    return term
+
+class JsonlEntitySink:
+    """Append-only JSONL output: one {"uri", "category", "depth"} record per line, flushed as found.
+
+    Reopening an existing file resumes it: the URIs already written are reported via `seen` and
+    are not written again. A final {"done": true} record tells readers tailing the file that the
+    crawl has finished.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.seen = set()
+        torn = False
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                if f.seek(0, os.SEEK_END):
+                    f.seek(-1, os.SEEK_END)
+                    torn = f.read(1) != b"\n"
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # partial last line from an interrupted run
+                    if "uri" in record:
+                        self.seen.add(record["uri"])
+        self.f = open(path, 'a', encoding='utf-8')
+        if torn:
+            self.f.write("\n")  # end the partial line so resumed records start on their own line
+
+    def write(self, uri: str, category: str, depth: int):
+        self.f.write(json.dumps({"uri": uri, "category": category, "depth": depth}, ensure_ascii=False) + "\n")
+        self.f.flush()
+
+    def close(self, total: int):
+        self.f.write(json.dumps({"done": True, "total": total}) + "\n")
+        self.f.close()
+
+
+class CategorySnapshot:
+    """A local, persistent copy of the DBpedia category graph, reused across crawls.
+
+    Every category and article URI is interned once in a string table. The graph is stored as
+    two CSR adjacency structures over string ids (category -> subcategories, category -> articles),
+    with a per-category fetch timestamp, as flat arrays in `path/`. Categories fetched during
+    this session are kept in `updates` and merged into the arrays on `save`. Saving holds
+    `path.lock` and re-reads the snapshot first, so crawls that share it keep each other's categories.
+    """
+    ARRAYS = {"sub_offsets": "q", "sub_targets": "i", "art_offsets": "q", "art_targets": "i", "fetched_at": "d"}
+
+    def __init__(self, path: str):
+        self.path = path
+        self.strings = []
+        self.index = {}
+        self.sub_offsets, self.sub_targets = array("q", [0]), array("i")
+        self.art_offsets, self.art_targets = array("q", [0]), array("i")
+        self.fetched_at = array("d")
+        self.updates = {}  # category uri -> (articles, subcategories, fetched_at)
+        if os.path.exists(os.path.join(path, "meta.json")):
+            self._load()
+
+    def _load(self):
+        with open(os.path.join(self.path, "meta.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(os.path.join(self.path, "strings.txt"), 'r', encoding='utf-8') as f:
+            content = f.read()
+        self.strings = content.split("\n") if content else []
+        self.index = {s: i for i, s in enumerate(self.strings)}
+        for name, typecode in self.ARRAYS.items():
+            values = array(typecode)
+            with open(os.path.join(self.path, f"{name}.bin"), 'rb') as f:
+                values.frombytes(f.read())
+            if meta.get("byteorder", sys.byteorder) != sys.byteorder:
+                values.byteswap()
+            setattr(self, name, values)
+
+    def _intern(self, value: str) -> int:
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.strings)
+            self.strings.append(value)
+        return i
+
+    def lookup(self, category_uri: str, max_age: float):
+        """Returns (articles, subcategories) if the category was fetched within `max_age` seconds, else None."""
+        if category_uri in self.updates:
+            articles, subcategories, _ = self.updates[category_uri]
+            return articles, subcategories
+        i = self.index.get(category_uri)
+        if i is None or i >= len(self.fetched_at) or not self.fetched_at[i] or time.time() - self.fetched_at[i] > max_age:
+            return None
+        articles = [self.strings[j] for j in self.art_targets[self.art_offsets[i]:self.art_offsets[i + 1]]]
+        subcategories = [self.strings[j] for j in self.sub_targets[self.sub_offsets[i]:self.sub_offsets[i + 1]]]
+        return articles, subcategories
+
+    def update(self, category_uri: str, articles: list, subcategories: list):
+        self.updates[category_uri] = (articles, subcategories, time.time())
+
+    def _acquire_lock(self, stale_after: float = 600.0) -> str:
+        lock_path = f"{self.path}.lock"
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > stale_after:
+                        os.remove(lock_path)  # left behind by a crashed save
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.2)
+                continue
+            os.write(fd, str(os.getpid()).encode("ascii"))
+            os.close(fd)
+            return lock_path
+
+    def save(self):
+        """Merges this session's updates into the snapshot on disk and swaps the result in atomically."""
+        if not self.updates:
+            return
+        parent = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(parent, exist_ok=True)
+        lock_path = self._acquire_lock()
+        try:
+            self._save_locked()
+        finally:
+            os.remove(lock_path)
+
+    def _save_locked(self):
+        # Another crawl may have saved since this one loaded; start from its version
+        old_path = f"{self.path}.old"
+        if not os.path.exists(self.path) and os.path.exists(old_path):
+            os.replace(old_path, self.path)  # a save crashed between its two renames
+        if os.path.exists(os.path.join(self.path, "meta.json")):
+            self._load()
+        updated = {}
+        for category_uri, (articles, subcategories, fetched_at) in self.updates.items():
+            i = self.index.get(category_uri)
+            if i is not None and i < len(self.fetched_at) and self.fetched_at[i] > fetched_at:
+                continue  # the other crawl fetched it more recently
+            updated[self._intern(category_uri)] = ([self._intern(a) for a in articles], [self._intern(c) for c in subcategories], fetched_at)
+
+        old_rows = len(self.fetched_at)
+        sub_offsets, sub_targets = array("q", [0]), array("i")
+        art_offsets, art_targets = array("q", [0]), array("i")
+        fetched_at = array("d")
+        for i in range(len(self.strings)):
+            if i in updated:
+                articles, subcategories, ts = updated[i]
+                art_targets.extend(articles)
+                sub_targets.extend(subcategories)
+            elif i < old_rows:
+                art_targets.extend(self.art_targets[self.art_offsets[i]:self.art_offsets[i + 1]])
+                sub_targets.extend(self.sub_targets[self.sub_offsets[i]:self.sub_offsets[i + 1]])
+                ts = self.fetched_at[i]
+            else:
+                ts = 0.0
+            art_offsets.append(len(art_targets))
+            sub_offsets.append(len(sub_targets))
+            fetched_at.append(ts)
+        self.sub_offsets, self.sub_targets = sub_offsets, sub_targets
+        self.art_offsets, self.art_targets = art_offsets, art_targets
+        self.fetched_at = fetched_at
+        self.updates = {}
+
+        tmp_path = f"{self.path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        with open(os.path.join(tmp_path, "strings.txt"), 'w', encoding='utf-8') as f:
+            f.write("\n".join(self.strings))
+        for name in self.ARRAYS:
+            with open(os.path.join(tmp_path, f"{name}.bin"), 'wb') as f:
+                getattr(self, name).tofile(f)
+        with open(os.path.join(tmp_path, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump({"version": 1, "byteorder": sys.byteorder, "strings": len(self.strings),
+                       "categories": sum(1 for ts in fetched_at if ts), "saved_at": time.time()}, f)
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.replace(self.path, old_path)
+        os.replace(tmp_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
 class EntityDiscoverer:
     """A simple crawler to discover entity URIs from DBpedia categories."""
-    def __init__(self, config):
+    def __init__(self, config, sink: JsonlEntitySink | None = None, snapshot: CategorySnapshot | None = None, max_age: float = float("inf")):
         self.config = config
+        self.sink = sink
+        self.snapshot = snapshot
+        self.max_age = max_age
+        from SPARQLWrapper import SPARQLWrapper
         self.sparql = SPARQLWrapper(config["sparql_endpoint"], agent=config["user_agent"])
         self.sparql.setTimeout(30)
-        self.sparql.setReturnFormat(JSON)
-        self.seen_entities = set()
+        self.sparql.setReturnFormat("tsv")
+        self.seen_entities = set(sink.seen) if sink else set()
+
+    def iter_select(self, variable: str, where: str, page_size: int | None = None):
+        """Yields the distinct values of `?variable` matching `where`, page by page.
+
+        Pages are ordered by the variable (inside a subquery, which Virtuoso requires for deep
+        OFFSETs) so they are stable, and each page's TSV response is parsed line by line as it
+        arrives instead of being loaded as one JSON document. `where` must use full IRIs since
+        PREFIX declarations are not allowed inside the subquery.
+        """
+        page_size = page_size or self.config["page_size"]
+        offset = 0
+        while True:
+            self.sparql.setQuery(f"""
+            SELECT ?{variable} WHERE {{
+                {{ SELECT DISTINCT ?{variable} WHERE {{ {where} }} ORDER BY ?{variable} }}
+            }} LIMIT {page_size} OFFSET {offset}
+            """)
+            response = self.sparql.query().response
+            rows = 0
+            try:
+                next(response, None)  # header line
+                for raw_line in response:
+                    line = raw_line.decode("utf-8").rstrip("\r\n")
+                    if not line:
+                        continue
+                    rows += 1
+                    yield _parse_tsv_term(line.split("\t", 1)[0])
+            finally:
+                response.close()
+            if rows < page_size:
+                return
+            offset += rows
 
     def get_entities_from_category(self, category_name: str, depth_limit: int, current_depth: int = 0) -> set:
         """Recursively fetches a set of unique entity URIs from a DBpedia category."""
@@ -26,39 +266,58 @@ class EntityDiscoverer:
 
         print(f"{'  ' * current_depth}[INFO] Crawling Category: '{category_name}' at depth {current_depth}")
         
-        # Query for articles directly associated with this category
-        query = f"""
-        PREFIX dct: <http://purl.org/dc/terms/>
-        SELECT DISTINCT ?article WHERE {{
-            ?article dct:subject <http://dbpedia.org/resource/Category:{category_name.replace(" ", "_")}> .
+        category_uri = f"http://dbpedia.org/resource/Category:{category_name.replace(' ', '_')}"
+        article_where = f"""
+            ?article <http://purl.org/dc/terms/subject> <{category_uri}> .
             FILTER(STRSTARTS(STR(?article), "http://dbpedia.org/resource/"))
-        }}
         """
-        self.sparql.setQuery(query)
-        
+        sub_where = f"?subCategory <http://www.w3.org/2004/02/skos/core#broader> <{category_uri}> ."
+
+        cached = self.snapshot.lookup(category_uri, self.max_age) if self.snapshot else None
+        recorded = None  # Articles kept for the snapshot entry while they stream to the sink
+        if cached:
+            articles, sub_categories = cached
+        else:
+            articles = self.iter_select("article", article_where)
+            sub_categories = None
+            if self.snapshot:
+                recorded = []
+
+        new_entities = set()
         try:
-            results = self.sparql.query().convert()
+            for article in articles:
+                if recorded is not None:
+                    if len(recorded) < self.config["snapshot_max_articles"]:
+                        recorded.append(article)
+                    else:
+                        print(f"{'  ' * current_depth}[INFO] '{category_name}' has over {self.config['snapshot_max_articles']} articles; not recording it in the snapshot.")
+                        recorded = None
+                if article not in self.seen_entities:
+                    self.seen_entities.add(article)
+                    new_entities.add(article)
+                    if self.sink:
+                        self.sink.write(article, category_name, current_depth)
         except Exception as e:
             print(f"[ERROR] SPARQL query failed for category {category_name}: {e}")
-            return set()
-            
-        entities = {r["article"]["value"] for r in results["results"]["bindings"]}
-        new_entities = entities - self.seen_entities
-        self.seen_entities.update(new_entities)
+            return new_entities
+
+        if recorded is not None:
+            # Fetch the sub-categories even at the depth limit, so the snapshot entry is complete
+            try:
+                sub_categories = list(self.iter_select("subCategory", sub_where))
+                self.snapshot.update(category_uri, recorded, sub_categories)
+            except Exception as e:
+                print(f"[ERROR] SPARQL sub-category query failed: {e}")
+                sub_categories = []
         
         # If depth allows, find subcategories and recurse
         if current_depth < depth_limit:
-            sub_query = f"""
-            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-            SELECT DISTINCT ?subCategory WHERE {{
-                ?subCategory skos:broader <http://dbpedia.org/resource/Category:{category_name.replace(" ", "_")}> .
-            }}
-            """
-            self.sparql.setQuery(sub_query)
             try:
-                sub_results = self.sparql.query().convert()
-                for r in tqdm(sub_results["results"]["bindings"], desc=f"{'  ' * (current_depth+1)}Sub-categories", leave=False):
-                    sub_cat_uri = r["subCategory"]["value"]
+                if sub_categories is None:
+                    # Materialised first so no page stays open while the recursion runs its own queries
+                    sub_categories = list(self.iter_select("subCategory", sub_where))
+                from tqdm import tqdm
+                for sub_cat_uri in tqdm(sub_categories, desc=f"{'  ' * (current_depth+1)}Sub-categories", leave=False):
                     if "Category:" in sub_cat_uri:
                         sub_cat_name = sub_cat_uri.split("Category:")[-1].replace("_", " ")
                         new_entities.update(self.get_entities_from_category(sub_cat_name, depth_limit, current_depth + 1))
@@ -67,25 +326,50 @@ class EntityDiscoverer:
 
         return new_entities
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Discover DBpedia entity URIs from a starting category.")
     parser.add_argument("--category", type=str, required=True, help="The starting DBpedia category (e.g., 'Science').")
     parser.add_argument("--depth", type=int, default=1, help="How many levels of sub-categories to crawl.")
-    parser.add_argument("--output", type=str, default="discovered_entities.json", help="The output JSON file to save the list of URIs.")
-    args = parser.parse_args()
+    parser.add_argument("--snapshot", type=str, default="category_snapshot", help="Directory of the local category-graph snapshot reused across crawls.")
+    parser.add_argument("--no-snapshot", action="store_true", help="Always query the endpoint and do not read or update the snapshot.")
+    parser.add_argument("--max-age-days", type=float, default=30.0, help="Snapshot entries older than this are refetched.")
+    parser.add_argument("--output", type=str, default="discovered_entities.jsonl", help="The output file. '.jsonl' streams URIs as they are found (and resumes an existing file); '.json' writes a single list at the end.")
+    args = parser.parse_args(argv)
 
     print(f"--- Starting Entity Discovery ---")
     print(f"Root Category: {args.category}, Depth: {args.depth}")
-    
-    discoverer = EntityDiscoverer(CONFIG)
-    all_entities = list(discoverer.get_entities_from_category(args.category, args.depth))
 
-    print(f"\n[SUCCESS] Discovered {len(all_entities)} unique entities.")
+    snapshot = None if args.no_snapshot else CategorySnapshot(args.snapshot)
+    if snapshot is not None and snapshot.strings:
+        print(f"[INFO] Loaded category snapshot '{args.snapshot}' ({len(snapshot.strings)} URIs).")
+    max_age = args.max_age_days * 86400
+
+    try:
+        if args.output.endswith(".jsonl"):
+            sink = JsonlEntitySink(args.output)
+            if sink.seen:
+                print(f"[INFO] Resuming '{args.output}' with {len(sink.seen)} URIs already discovered.")
+            discoverer = EntityDiscoverer(CONFIG, sink=sink, snapshot=snapshot, max_age=max_age)
+            discoverer.get_entities_from_category(args.category, args.depth)
+            sink.close(len(discoverer.seen_entities))
+            print(f"\n[SUCCESS] Discovered {len(discoverer.seen_entities)} unique entities.")
+            print(f"URIs streamed to '{args.output}'.")
+            return
+
+        discoverer = EntityDiscoverer(CONFIG, snapshot=snapshot, max_age=max_age)
+        all_entities = list(discoverer.get_entities_from_category(args.category, args.depth))
+
+        print(f"\n[SUCCESS] Discovered {len(all_entities)} unique entities.")
 
-    with open(args.output, 'w') as f:
-        json.dump(all_entities, f, indent=2)
+        with open(args.output, 'w') as f:
+            json.dump(all_entities, f, indent=2)
 
-    print(f"List of URIs saved to '{args.output}'.")
+        print(f"List of URIs saved to '{args.output}'.")
+    finally:
+        # Saved even after a failure, so the categories fetched so far are not queried again
+        if snapshot is not None and snapshot.updates:
+            snapshot.save()
+            print(f"[INFO] Category snapshot saved to '{args.snapshot}'.")
 
 if __name__ == "__main__":
     main()
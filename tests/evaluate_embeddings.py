@@ -0,0 +1,452 @@
+
+import os
+import csv
+import json
+import pickle
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# numpy is imported inside the functions that use it, so `--help` works without it installed.
+
+# --- Configuration ---
+CONFIG = {
+    "block_size": 1024, # Query rows scored per task
+    "prototype_chunk": 8192, # Prototypes held against a query block at once; one task needs block_size x prototype_chunk floats
+    "ks": (1, 5, 10, 50),
+    "temperature": 0.05, # Softmax temperature turning prototype similarities into a confidence
+    "bins": 10, # Reliability bins for ECE, as in Theoretical_Framing_and_Expected_Behaviors.md
+    "pair_chunk": 65536, # Hop pairs whose prototype distances are computed at once
+}
+
+
+# --- Embedding store ---
+# A directory of memory-mapped arrays, so no pass ever holds the full matrix in memory:
+#   embeddings.npy   float32 [N, D]
+#   subject_ids.npy  int32 [N], index into uris.txt
+#   uris.txt         one subject URI per line; ids below meta["num_prototypes"] have embeddings
+#   probs.npy, pred_ids.npy  optional classifier confidence and predicted URI id (NaN / -1 if absent)
+# Exporters that produce millions of vectors should write this layout directly; `export_pickle`
+# converts the `eval_embeddings.pkl` list of {'text_id', 'subject_uri', 'embedding'[, 'prob', 'pred_uri']}.
+
+def export_pickle(pkl_path: str, store_dir: str):
+    """Converts an `eval_embeddings.pkl` list of dicts into a store directory."""
+    import numpy as np
+    with open(pkl_path, 'rb') as f:
+        data = pickle.load(f)
+    if not data:
+        raise ValueError(f"{pkl_path} holds no embeddings")
+    os.makedirs(store_dir, exist_ok=True)
+
+    uris = {}
+    for item in data:
+        uris.setdefault(item["subject_uri"], len(uris))
+    num_prototypes = len(uris)
+    # Predicted URIs without embeddings of their own get ids after all subjects, so they have no prototype
+    for item in data:
+        if item.get("pred_uri") is not None:
+            uris.setdefault(item["pred_uri"], len(uris))
+
+    n, dim = len(data), len(data[0]["embedding"])
+    embeddings = np.lib.format.open_memmap(os.path.join(store_dir, "embeddings.npy"), mode="w+", dtype=np.float32, shape=(n, dim))
+    subject_ids = np.empty(n, dtype=np.int32)
+    probs = np.full(n, np.nan, dtype=np.float32)
+    pred_ids = np.full(n, -1, dtype=np.int32)
+    for i, item in enumerate(data):
+        embeddings[i] = item["embedding"]
+        subject_ids[i] = uris[item["subject_uri"]]
+        if item.get("prob") is not None:
+            probs[i] = item["prob"]
+        if item.get("pred_uri") is not None:
+            pred_ids[i] = uris[item["pred_uri"]]
+    embeddings.flush()
+    np.save(os.path.join(store_dir, "subject_ids.npy"), subject_ids)
+    if not np.isnan(probs).all():
+        np.save(os.path.join(store_dir, "probs.npy"), probs)
+        np.save(os.path.join(store_dir, "pred_ids.npy"), pred_ids)
+    with open(os.path.join(store_dir, "uris.txt"), 'w', encoding='utf-8') as f:
+        f.write("\n".join(uris))
+    with open(os.path.join(store_dir, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump({"embeddings": n, "dim": dim, "num_prototypes": num_prototypes}, f)
+
+
+def load_uris(store_dir: str) -> list:
+    with open(os.path.join(store_dir, "uris.txt"), 'r', encoding='utf-8') as f:
+        return f.read().split("\n")
+
+
+def _normalize(x):
+    import numpy as np
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def build_prototypes(store_dir: str, block_size: int) -> int:
+    """One streaming pass: per-URI sums of unit embeddings, counts, and unit prototypes, written to the store."""
+    import numpy as np
+    with open(os.path.join(store_dir, "meta.json"), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    embeddings = np.load(os.path.join(store_dir, "embeddings.npy"), mmap_mode="r")
+    subject_ids = np.load(os.path.join(store_dir, "subject_ids.npy"), mmap_mode="r")
+    num_prototypes, dim = meta["num_prototypes"], embeddings.shape[1]
+
+    sums = np.lib.format.open_memmap(os.path.join(store_dir, "prototype_sums.npy"), mode="w+", dtype=np.float32, shape=(num_prototypes, dim))
+    counts = np.zeros(num_prototypes, dtype=np.int64)
+    for start in range(0, len(embeddings), block_size):
+        x = _normalize(np.asarray(embeddings[start:start + block_size], dtype=np.float32))
+        ids = np.asarray(subject_ids[start:start + block_size])
+        # Sorting the block lets reduceat sum each URI's rows in one vectorized call
+        order = np.argsort(ids, kind="stable")
+        unique_ids, starts = np.unique(ids[order], return_index=True)
+        sums[unique_ids] += np.add.reduceat(x[order], starts, axis=0)
+        counts += np.bincount(ids, minlength=num_prototypes)
+    sums.flush()
+    np.save(os.path.join(store_dir, "prototype_counts.npy"), counts)
+
+    prototypes = np.lib.format.open_memmap(os.path.join(store_dir, "prototypes.npy"), mode="w+", dtype=np.float32, shape=(num_prototypes, dim))
+    for start in range(0, num_prototypes, block_size):
+        prototypes[start:start + block_size] = _normalize(np.asarray(sums[start:start + block_size]))
+    prototypes.flush()
+    return num_prototypes
+
+
+# --- Blockwise scoring (runs in worker processes) ---
+_store = None
+
+
+def _init_worker(store_dir: str):
+    global _store
+    import numpy as np
+    _store = {"dir": store_dir}
+    for name in ("embeddings", "subject_ids", "prototype_sums", "prototype_counts", "prototypes", "probs", "pred_ids"):
+        path = os.path.join(store_dir, f"{name}.npy")
+        _store[name] = np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
+
+def _reliability(confidence, correct, bins: int):
+    import numpy as np
+    bin_index = np.minimum((confidence * bins).astype(np.int64), bins - 1)
+    return (np.bincount(bin_index, minlength=bins),
+            np.bincount(bin_index, weights=confidence, minlength=bins),
+            np.bincount(bin_index, weights=correct.astype(np.float64), minlength=bins))
+
+
+def _score_queries(start: int, stop: int, ks, temperature: float, bins: int, chunk: int) -> dict:
+    """Ranks each query's own prototype among all prototypes, and accumulates the metric sums for the block.
+
+    The own prototype is compared leave-one-out (without the query's own embedding), so a URI with a
+    single embedding cannot retrieve itself and is counted separately. Instead of keeping a top-k list,
+    each chunk adds the number of prototypes scoring above the own one, which gives recall@k for every
+    k and the reciprocal rank at once. The top-1 match and a streaming log-sum-exp give the softmax
+    confidence used for calibration.
+    """
+    import numpy as np
+    x = _normalize(np.asarray(_store["embeddings"][start:stop], dtype=np.float32))
+    true = np.asarray(_store["subject_ids"][start:stop], dtype=np.int64)
+    rows = np.arange(len(x))
+    counts = np.asarray(_store["prototype_counts"][true])
+    sums = np.asarray(_store["prototype_sums"][true], dtype=np.float32)
+
+    dot = np.einsum("ij,ij->i", x, sums)
+    sim_full = dot / np.maximum(np.linalg.norm(sums, axis=1), 1e-12)
+    valid = counts > 1
+    loo_norm = np.linalg.norm(sums - x, axis=1)
+    own_sim = np.where(valid, (dot - np.einsum("ij,ij->i", x, x)) / np.maximum(loo_norm, 1e-12), -np.inf)
+    threshold = np.where(valid, own_sim, np.inf)
+
+    prototypes = _store["prototypes"]
+    rank = np.zeros(len(x), dtype=np.int64)
+    top_sim = np.full(len(x), -np.inf)
+    top_id = np.full(len(x), -1, dtype=np.int64)
+    log_norm = np.full(len(x), -np.inf)
+    for c0 in range(0, len(prototypes), chunk):
+        sims = x @ np.asarray(prototypes[c0:c0 + chunk]).T
+        own = (true >= c0) & (true < c0 + sims.shape[1])
+        sims[rows[own], true[own] - c0] = own_sim[own]
+        rank += (sims > threshold[:, None]).sum(axis=1)
+        best = sims.argmax(axis=1)
+        best_sim = sims[rows, best]
+        better = best_sim > top_sim
+        top_sim[better], top_id[better] = best_sim[better], best[better] + c0
+        logits = sims / temperature
+        peak = logits.max(axis=1)
+        log_norm = np.logaddexp(log_norm, peak + np.log(np.exp(logits - peak[:, None]).sum(axis=1)))
+
+    v_rank = rank[valid]
+    result = {
+        "queries": int(valid.sum()),
+        "singletons": int((~valid).sum()),
+        "hits": {k: int((v_rank < k).sum()) for k in ks},
+        "reciprocal_rank": float((1.0 / (v_rank + 1)).sum()),
+        "reliability": _reliability(np.exp(top_sim / temperature - log_norm)[valid], (top_id == true)[valid], bins),
+        "intra_ids": true,
+        "intra_distance": 1.0 - sim_full,
+    }
+    if _store["probs"] is not None:
+        probs = np.asarray(_store["probs"][start:stop], dtype=np.float64)
+        known = ~np.isnan(probs)
+        pred = np.asarray(_store["pred_ids"][start:stop])
+        result["classifier_reliability"] = _reliability(np.clip(probs[known], 0.0, 1.0), (pred == true)[known], bins)
+    return result
+
+
+def _nearest_prototypes(start: int, stop: int, chunk: int):
+    """For prototypes [start, stop), the most similar other prototype and its similarity."""
+    import numpy as np
+    prototypes = _store["prototypes"]
+    q = np.asarray(prototypes[start:stop])
+    rows = np.arange(len(q))
+    own = np.arange(start, start + len(q))
+    best_sim = np.full(len(q), -np.inf)
+    best_id = np.full(len(q), -1, dtype=np.int64)
+    for c0 in range(0, len(prototypes), chunk):
+        sims = q @ np.asarray(prototypes[c0:c0 + chunk]).T
+        in_chunk = (own >= c0) & (own < c0 + sims.shape[1])
+        sims[rows[in_chunk], own[in_chunk] - c0] = -np.inf
+        best = sims.argmax(axis=1)
+        sim = sims[rows, best]
+        better = sim > best_sim
+        best_sim[better], best_id[better] = sim[better], best[better] + c0
+    return start, best_sim, best_id
+
+
+def _run_tasks(fn, tasks, workers: int, store_dir: str, collect):
+    """Runs fn(*task) for every task across `workers` processes, keeping at most 2 tasks per worker in flight."""
+    if workers <= 1:
+        _init_worker(store_dir)
+        for task in tasks:
+            collect(fn(*task))
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(store_dir,)) as pool:
+        in_flight = deque()
+        for task in tasks:
+            in_flight.append(pool.submit(fn, *task))
+            if len(in_flight) >= 2 * workers:
+                collect(in_flight.popleft().result())
+        while in_flight:
+            collect(in_flight.popleft().result())
+
+
+# --- Metrics ---
+
+def _ece(reliability) -> float:
+    import numpy as np
+    count, confidence, correct = reliability
+    total = count.sum()
+    if not total:
+        return float("nan")
+    nonempty = count > 0
+    return float((np.abs(correct[nonempty] - confidence[nonempty])).sum() / total)
+
+
+def _rankdata(values):
+    """Ranks with ties averaged (as scipy.stats.rankdata), for Spearman correlation without scipy."""
+    import numpy as np
+    order = np.argsort(values, kind="mergesort")
+    ordered = values[order]
+    first = np.r_[True, ordered[1:] != ordered[:-1]]
+    starts = np.flatnonzero(first)
+    ends = np.r_[starts[1:], len(values)]
+    ranks = np.empty(len(values))
+    ranks[order] = ((starts + ends - 1) / 2.0)[np.cumsum(first) - 1]
+    return ranks
+
+
+def spearman(a, b) -> float:
+    import numpy as np
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    if len(a) < 2 or np.all(a == a[0]) or np.all(b == b[0]):
+        return float("nan")
+    return float(np.corrcoef(_rankdata(a), _rankdata(b))[0, 1])
+
+
+def hop_distance_correlation(store_dir: str, hops_path: str, chunk: int) -> dict:
+    """μ_h (mean cosine distance between prototypes h hops apart) and its Spearman correlation with h.
+
+    `hops_path` is the `hop_counts.pkl` mapping {(uri_u, uri_v): hop_count}. On unit prototypes the
+    Euclidean distance of the design doc is a monotone function of the cosine distance, so the rank
+    correlations are the same.
+    """
+    import numpy as np
+    with open(hops_path, 'rb') as f:
+        hops = pickle.load(f)
+    uris = load_uris(store_dir)
+    prototypes = np.load(os.path.join(store_dir, "prototypes.npy"), mmap_mode="r")
+    index = {uri: i for i, uri in enumerate(uris[:len(prototypes)])}
+    pairs = [(index[u], index[v], h) for (u, v), h in hops.items() if u in index and v in index and u != v]
+    del hops
+    if not pairs:
+        return {"pairs": 0}
+    pairs = np.array(pairs, dtype=np.int64)
+
+    distances = np.empty(len(pairs))
+    for start in range(0, len(pairs), chunk):
+        u, v = pairs[start:start + chunk, 0], pairs[start:start + chunk, 1]
+        distances[start:start + chunk] = 1.0 - np.einsum("ij,ij->i", np.asarray(prototypes[u]), np.asarray(prototypes[v]))
+    hop_values = pairs[:, 2]
+    levels = np.unique(hop_values)
+    mu_h = {int(h): float(distances[hop_values == h].mean()) for h in levels}
+    return {
+        "pairs": int(len(pairs)),
+        "mu_h": mu_h,
+        "pairs_per_hop": {int(h): int((hop_values == h).sum()) for h in levels},
+        "spearman_levels": spearman(list(mu_h), list(mu_h.values())),
+        "spearman_pairs": spearman(hop_values, distances),
+    }
+
+
+def evaluate(store_dir: str, out_dir: str, workers: int, hops_path: str | None = None) -> dict:
+    """Runs every metric over the store and writes metrics.json plus CSV tables to `out_dir`."""
+    import numpy as np
+    ks, bins, chunk, block_size = CONFIG["ks"], CONFIG["bins"], CONFIG["prototype_chunk"], CONFIG["block_size"]
+    os.makedirs(out_dir, exist_ok=True)
+    print("[PHASE 1] Building prototypes...")
+    num_prototypes = build_prototypes(store_dir, block_size)
+    num_embeddings = len(np.load(os.path.join(store_dir, "subject_ids.npy"), mmap_mode="r"))
+    counts = np.load(os.path.join(store_dir, "prototype_counts.npy"))
+    print(f"[PHASE 1] {num_embeddings} embeddings, {num_prototypes} prototypes.")
+
+    print("[PHASE 2] Scoring queries against prototypes...")
+    totals = {"queries": 0, "singletons": 0, "hits": {k: 0 for k in ks}, "reciprocal_rank": 0.0}
+    reliability = [np.zeros(bins), np.zeros(bins), np.zeros(bins)]
+    classifier = [np.zeros(bins), np.zeros(bins), np.zeros(bins)]
+    intra_sum = np.zeros(num_prototypes)
+
+    def collect_queries(result):
+        totals["queries"] += result["queries"]
+        totals["singletons"] += result["singletons"]
+        totals["reciprocal_rank"] += result["reciprocal_rank"]
+        for k in ks:
+            totals["hits"][k] += result["hits"][k]
+        for acc, part in zip(reliability, result["reliability"]):
+            acc += part
+        for acc, part in zip(classifier, result.get("classifier_reliability", ())):
+            acc += part
+        np.add.at(intra_sum, result["intra_ids"], result["intra_distance"])
+
+    tasks = [(start, min(start + block_size, num_embeddings), ks, CONFIG["temperature"], bins, chunk)
+             for start in range(0, num_embeddings, block_size)]
+    _run_tasks(_score_queries, tasks, workers, store_dir, collect_queries)
+
+    print("[PHASE 3] Finding nearest prototypes...")
+    nearest_sim = np.empty(num_prototypes)
+    nearest_id = np.empty(num_prototypes, dtype=np.int64)
+
+    def collect_nearest(result):
+        start, sim, ids = result
+        nearest_sim[start:start + len(sim)] = sim
+        nearest_id[start:start + len(sim)] = ids
+
+    tasks = [(start, min(start + block_size, num_prototypes), chunk) for start in range(0, num_prototypes, block_size)]
+    _run_tasks(_nearest_prototypes, tasks, workers, store_dir, collect_nearest)
+
+    queries = totals["queries"]
+    intra = intra_sum / np.maximum(counts, 1)
+    nearest_distance = 1.0 - nearest_sim
+    multi = counts > 1
+    report = {
+        "embeddings": num_embeddings,
+        "prototypes": num_prototypes,
+        "retrieval": {
+            "queries": queries,
+            "singletons_skipped": totals["singletons"],
+            "recall": {f"@{k}": (totals["hits"][k] / queries if queries else 0.0) for k in ks},
+            "mrr": totals["reciprocal_rank"] / queries if queries else 0.0,
+        },
+        "calibration": {"temperature": CONFIG["temperature"], "bins": bins, "retrieval_ece": _ece(reliability)},
+        "prototype_stats": {
+            "support_min": int(counts.min()), "support_median": float(np.median(counts)),
+            "support_mean": float(counts.mean()), "support_max": int(counts.max()),
+            "mean_intra_distance": float(intra[multi].mean()) if multi.any() else float("nan"),
+            "mean_nearest_prototype_distance": float(nearest_distance.mean()) if num_prototypes > 1 else float("nan"),
+            # A prototype whose nearest neighbour is closer than its own members are on average overlaps it
+            "overlapping_fraction": float((nearest_distance[multi] < intra[multi]).mean()) if multi.any() else float("nan"),
+        },
+    }
+    if classifier[0].sum():
+        report["calibration"]["classifier_ece"] = _ece(classifier)
+    if hops_path:
+        print("[PHASE 4] Correlating prototype distance with hop distance...")
+        report["hops"] = hop_distance_correlation(store_dir, hops_path, CONFIG["pair_chunk"])
+
+    write_tables(out_dir, store_dir, report, reliability, classifier, counts, intra, nearest_id, nearest_distance)
+    return report
+
+
+def write_tables(out_dir, store_dir, report, reliability, classifier, counts, intra, nearest_id, nearest_distance):
+    with open(os.path.join(out_dir, "metrics.json"), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    with open(os.path.join(out_dir, "recall.csv"), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["k", "recall"])
+        for k, value in report["retrieval"]["recall"].items():
+            writer.writerow([k.lstrip("@"), f"{value:.6f}"])
+
+    bins = CONFIG["bins"]
+    with open(os.path.join(out_dir, "reliability.csv"), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["source", "bin_lower", "bin_upper", "count", "mean_confidence", "accuracy"])
+        for source, (count, confidence, correct) in (("retrieval", reliability), ("classifier", classifier)):
+            for i in range(bins):
+                if count[i]:
+                    writer.writerow([source, f"{i / bins:.2f}", f"{(i + 1) / bins:.2f}", int(count[i]),
+                                     f"{confidence[i] / count[i]:.6f}", f"{correct[i] / count[i]:.6f}"])
+
+    uris = load_uris(store_dir)
+    with open(os.path.join(out_dir, "prototype_stats.csv"), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["subject_uri", "support", "mean_intra_distance", "nearest_uri", "nearest_distance"])
+        for i in range(len(counts)):
+            nearest = uris[nearest_id[i]] if nearest_id[i] >= 0 else ""
+            writer.writerow([uris[i], int(counts[i]), f"{intra[i]:.6f}", nearest, f"{nearest_distance[i]:.6f}"])
+
+    if "mu_h" in report.get("hops", {}):
+        with open(os.path.join(out_dir, "hop_distance.csv"), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["hop", "pairs", "mean_distance"])
+            for h, mu in report["hops"]["mu_h"].items():
+                writer.writerow([h, report["hops"]["pairs_per_hop"][h], f"{mu:.6f}"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate exported embeddings: recall@k against per-URI prototypes, prototype statistics, hop-distance correlation and ECE.")
+    parser.add_argument("--input", type=str, default="eval_embeddings.pkl", help="eval_embeddings.pkl, or a store directory with embeddings.npy/subject_ids.npy/uris.txt.")
+    parser.add_argument("--store", type=str, default="eval_store", help="Where a pickle input is converted to memory-mapped arrays.")
+    parser.add_argument("--hops", type=str, default=None, help="hop_counts.pkl with {(uri_u, uri_v): hops} for the hop-distance correlation.")
+    parser.add_argument("--output", type=str, default="eval_report", help="Directory for metrics.json and the CSV tables.")
+    parser.add_argument("--k", type=int, nargs="+", default=list(CONFIG["ks"]), help="Cut-offs for recall@k.")
+    parser.add_argument("--temperature", type=float, default=CONFIG["temperature"], help="Softmax temperature over prototype similarities for calibration.")
+    parser.add_argument("--bins", type=int, default=CONFIG["bins"], help="Reliability bins for ECE.")
+    parser.add_argument("--block-size", type=int, default=CONFIG["block_size"], help="Query rows per task.")
+    parser.add_argument("--prototype-chunk", type=int, default=CONFIG["prototype_chunk"], help="Prototypes compared against a block at once.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes.")
+    args = parser.parse_args(argv)
+
+    CONFIG.update({"ks": tuple(sorted(set(args.k))), "temperature": args.temperature, "bins": args.bins,
+                   "block_size": args.block_size, "prototype_chunk": args.prototype_chunk})
+
+    print("--- Starting Embedding Evaluation ---")
+    store_dir = args.input
+    if not os.path.isdir(args.input):
+        print(f"[INFO] Converting '{args.input}' to a memory-mapped store in '{args.store}'...")
+        export_pickle(args.input, args.store)
+        store_dir = args.store
+    report = evaluate(store_dir, args.output, args.workers, args.hops)
+
+    retrieval = report["retrieval"]
+    print(f"\n[INFO] {retrieval['queries']} queries ({retrieval['singletons_skipped']} singleton URIs skipped), {report['prototypes']} prototypes.")
+    for k, value in retrieval["recall"].items():
+        print(f"  recall{k:<6} {value:7.2%}")
+    print(f"  MRR          {retrieval['mrr']:.4f}")
+    print(f"  ECE          {report['calibration']['retrieval_ece']:.4f} (retrieval, T={args.temperature})")
+    if "classifier_ece" in report["calibration"]:
+        print(f"  ECE          {report['calibration']['classifier_ece']:.4f} (classifier)")
+    stats = report["prototype_stats"]
+    print(f"  intra / nearest-prototype distance  {stats['mean_intra_distance']:.4f} / {stats['mean_nearest_prototype_distance']:.4f}")
+    if "spearman_pairs" in report.get("hops", {}):
+        print(f"  hop-distance Spearman  {report['hops']['spearman_pairs']:.4f} over {report['hops']['pairs']} pairs")
+    print(f"[SUCCESS] Metrics written to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
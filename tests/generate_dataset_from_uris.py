@@ -4,20 +4,23 @@ import random
 import time
 import re
 import json
+import hashlib
 import argparse
-import pandas as pd
-from tqdm import tqdm
-from SPARQLWrapper import SPARQLWrapper, JSON
+import functools
+from collections import OrderedDict
 
-# Cloud and Iceberg specific imports
-import pyarrow as pa
-from pyiceberg.catalog import load_catalog
+# pyarrow, pyiceberg, SPARQLWrapper and tqdm are imported inside the functions that use them, so
+# `--help`, short shard jobs and library imports do not pay for loading them up front.
+from stage_profiler import NULL_PROFILER, StageProfiler
 
 # --- Configuration ---
 CONFIG = {
     # --- Input and Output ---
     "s3_warehouse": "s3://your-unique-bucket-name/iceberg-data", # IMPORTANT: Change to your S3 bucket URI.
     "iceberg_table_name": "dbpedia.physics_triplets_multilingual",
+    "fingerprint_table_name": "dbpedia.physics_triplets_multilingual_fingerprints", # One fingerprint per processed subject, including those without rows.
+    "uri_id_table_name": "dbpedia.uri_to_id", # Persistent subject_uri -> subject_uri_id allocations (the classification head's class ids).
+    "staging_dir": "s3://your-unique-bucket-name/iceberg-data/staging", # Where shard workers write data files before the coordinator commits them.
 
     # --- API & Networking ---
     "sparql_endpoint": "https://dbpedia.org/sparql",
@@ -25,15 +28,149 @@ CONFIG = {
     
     # --- Data Generation ---
     "primary_language": "en",
+    "negatives_per_anchor": 1,
+    "max_tokens": 512, # Token ids per field kept by the --tokenizer stage
+    "prefilter_batch_size": 500, # URIs per aggregate query in the --prefilter pass
+    "fingerprint_batch_size": 100, # URIs per aggregate fingerprint query; smaller than the prefilter batch since it joins 2 hops
+    "min_comment_chars": 150,
+    "label_batch_size": 200, # URIs per bulk rdfs:label query
+    "label_index_max_entities": 200000, # The label index is reset once it holds this many entities
+    "max_swaps_per_negative": 1,
+    "neighbourhood_batch_size": 20, # Nodes per bulk 1-hop query when assembling entity graphs
+    "neighbourhood_cache_max_triples": 2000000, # Least recently used neighbourhoods are evicted beyond this
+    "sparql_max_rows": 10000, # Result row limit of the endpoint; a batch that hits it is split and retried
+    "max_rdf_triples": 10000, # Cap on an assembled 2-hop graph, as the endpoint capped the old CONSTRUCT
+    "llm_pack_size": 8, # Entities packed into one LLM association request (--llm-backend)
+    "llm_concurrency": 4, # LLM requests in flight at once
+    "llm_max_retries": 2, # Individual retries for an entity whose part of a packed response did not validate
+    "llm_max_pack_chars": 12000, # Prompt size cap for a pack, so long descriptions get smaller packs
+
+    # --- Table Layout ---
+    "subject_buckets": 16, # Hash buckets of subject_uri_id in the partition spec
 }
 
 
+@functools.cache
+def triplet_schema():
+    """The Arrow schema of the triplet table."""
+    import pyarrow as pa
+    from training_columns import training_schema_fields
+    return pa.schema([
+        pa.field("anchor_text", pa.string()), pa.field("anchor_rdf", pa.string()), pa.field("positive_text", pa.string()),
+        pa.field("negative_text", pa.string()), pa.field("negative_rdf", pa.string()),
+        pa.field("subject_uri", pa.string()), pa.field("subject_uri_id", pa.int64()),
+        # Language of the anchor text, or its source when it is not a DBpedia comment (e.g. "en_llm_assoc")
+        pa.field("lang_code", pa.string()),
+        pa.field("input_fingerprint", pa.string()),
+        pa.field("negative_swaps", pa.int32()), pa.field("negative_difficulty", pa.string()),
+        # Filled only when generation runs with --tokenizer (see training_columns.py)
+        *training_schema_fields(),
+    ])
+
+# Rows are partitioned by a hash bucket of the subject and by language, and sorted the same way within
+# each data file, so per-language reads and entity-bucket splits skip most files. Long text columns
+# only keep counts in the manifests; min/max bounds of those would be large and never prune anything.
+SORT_COLUMNS = [("lang_code", "ascending"), ("subject_uri_id", "ascending")]
+
+
+def table_properties() -> dict:
+    """Iceberg table properties: per-column metrics modes for the data file statistics."""
+    return {
+        "write.metadata.metrics.default": "truncate(16)",
+        "write.metadata.metrics.column.subject_uri": "full",
+        "write.metadata.metrics.column.subject_uri_id": "full",
+        "write.metadata.metrics.column.lang_code": "full",
+        **{f"write.metadata.metrics.column.{f.name}": "counts"
+           for f in triplet_schema() if str(f.type) == "string" and f.name.endswith(("_text", "_rdf", "_linear"))},
+    }
+
+
+def negative_difficulty(num_swaps: int) -> str:
+    """A negative with a single swap differs least from its anchor, so it is the hardest to reject."""
+    return {1: "hard", 2: "medium"}.get(num_swaps, "easy")
+
+
+def shard_for_uri(uri: str, num_shards: int) -> int:
+    """Shards by a hash of the URI itself, so the split survives reordering of the input list."""
+    return int.from_bytes(hashlib.sha1(uri.encode("utf-8")).digest()[:8], "big") % num_shards
+
+
+def compute_input_fingerprint(comment_digest: str, rdf_digest: str) -> str:
+    """Fingerprints everything generation reads for an entity: the digests of its usable comments and of its 2-hop RDF."""
+    return hashlib.sha256(f"{comment_digest}\x1e{rdf_digest}".encode("utf-8")).hexdigest()
+
+
+def _sparql_hash_number(expr: str) -> str:
+    """A SPARQL expression mapping a string to a 12-digit integer taken from its MD5.
+
+    Per-subject SUMs of these are digests that do not depend on result order, which SPARQL leaves
+    undefined for GROUP_CONCAT. Hex letters are mapped onto digits since SPARQL cannot parse hex;
+    12 digits keep the sum over a large graph within a 64-bit integer.
+    """
+    hexed = f"MD5({expr})"
+    for letter, digit in zip("abcdef", "012345"):
+        hexed = f'REPLACE({hexed}, "{letter}", "{digit}")'
+    return f"xsd:integer(SUBSTR({hexed}, 1, 12))"
+
+
+def iter_entity_uris(path: str, follow: bool = False, poll_interval: float = 1.0, idle_timeout: float | None = None):
+    """Yields entity URIs from a JSON list or a discovery JSONL stream.
+
+    With `follow`, a JSONL file is tailed like `tail -f` while `discover_entities.py` is still
+    writing it, until a {"done": true} record appears with nothing after it (a resumed crawl
+    appends after an earlier one). Lines that do not decode, such as one torn by a crash, are skipped.
+    A followed file need not exist yet. If it does not appear or grow for `idle_timeout` seconds
+    (discovery died before writing "done"), TimeoutError is raised.
+    """
+    idle_since = time.monotonic()
+
+    def wait():
+        if idle_timeout and time.monotonic() - idle_since > idle_timeout:
+            raise TimeoutError(f"No new input in '{path}' for {idle_timeout:g}s; discovery may have stopped without finishing.")
+        time.sleep(poll_interval)
+
+    while follow and not os.path.exists(path):
+        wait()
+    if not path.endswith(".jsonl"):
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from json.load(f)
+        return
+
+    with open(path, 'r', encoding='utf-8') as f:
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line.endswith("\n"):
+                if not follow:
+                    return
+                f.seek(position)  # incomplete line: the writer has not flushed it yet
+                wait()
+                continue
+            idle_since = time.monotonic()
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("done"):
+                if follow:
+                    position = f.tell()
+                    if not f.readline():
+                        return
+                    f.seek(position)
+                continue  # a resumed crawl may have appended after an earlier "done"
+            if "uri" in record:
+                yield record["uri"]
+                idle_since = time.monotonic()  # time spent by the consumer is not idle input
+
+
 def generate_paraphrase(text: str) -> str:
     """(Placeholder) Generates a paraphrased version of the text."""
     return "From a different perspective, " + text.lower()
 
 def generate_llm_associations(title: str, description: str, num_rows=5) -> list[str]:
-    """(Placeholder) Generates multiple associative text rows from a single resource."""
+    """(Placeholder) Generates multiple associative text rows from a single resource. Used when no --llm-backend is set."""
     return [
         f"Considering the historical context, {title} emerged as a significant concept following...",
         f"For a beginner, the most important thing to understand about {title} is that it relates to...",
@@ -42,17 +179,173 @@ def generate_llm_associations(title: str, description: str, num_rows=5) -> list[
         f"An interesting and often debated aspect of {title} is...",
     ]
 
+# Scripts written without spaces between words, where regex word boundaries cannot delimit a label
+UNSEGMENTED_LANGS = {"ja", "zh", "th"}
+
+
+def _surface_pattern(surface: str, lang: str | None) -> str:
+    if lang in UNSEGMENTED_LANGS:
+        return re.escape(surface)
+    return r'\b' + re.escape(surface) + r'\b'
+
+
+class LabelIndex:
+    """Bulk-fetched `rdfs:label`s keyed by entity and language, used as text surface forms for swaps.
+
+    `ensure` fetches the labels of many entities (by URI) with one VALUES query per batch and remembers
+    which (entity, language) pairs were already asked for, so substitution never queries per attempt.
+    Without a label, the URI local name is used for the fallback language (English), as before.
+    """
+    def __init__(self, processor, fallback_lang: str = "en"):
+        self.processor = processor
+        self.fallback_lang = fallback_lang
+        self.labels = {}   # uri -> {lang: label}
+        self.checked = {}  # uri -> set of langs already queried
+
+    def ensure(self, entity_uris, langs):
+        langs = sorted(set(langs))
+        missing = sorted({uri for uri in entity_uris if not set(langs) <= self.checked.get(uri, set())})
+        if not missing:
+            return
+        if len(self.checked) + len(missing) > self.processor.config["label_index_max_entities"]:
+            self.labels.clear()
+            self.checked.clear()
+        batch_size = self.processor.config["label_batch_size"]
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            fetched = self.processor.fetch_labels(batch, langs)
+            if fetched is None:
+                continue  # Leave unchecked so a later call can retry
+            for uri in batch:
+                if uri in fetched:
+                    self.labels.setdefault(uri, {}).update(fetched[uri])
+                self.checked.setdefault(uri, set()).update(langs)
+
+    def surface(self, entity_uri: str, lang: str | None) -> str | None:
+        label = self.labels.get(entity_uri, {}).get(lang)
+        if label:
+            return _strip_disambiguation(label)
+        if lang is None or lang == self.fallback_lang:
+            return _uri_surface(entity_uri)
+        return None
+
+
+DBR = "http://dbpedia.org/resource/"
+DBO = "http://dbpedia.org/ontology/"
+TURTLE_PREFIXES = f"@prefix dbr:\t<{DBR}> .\n@prefix dbo:\t<{DBO}> .\n"
+
+
+def _turtle_iri(iri: str) -> str:
+    for prefix, namespace in (("dbr", DBR), ("dbo", DBO)):
+        if iri.startswith(namespace) and re.fullmatch(r"\w[\w-]*", iri[len(namespace):]):
+            return f"{prefix}:{iri[len(namespace):]}"
+    return f"<{iri}>"
+
+
+def _turtle_term(node: dict) -> str:
+    """Turtle form of a SPARQL JSON result term (IRI or literal)."""
+    if node["type"] == "uri":
+        return _turtle_iri(node["value"])
+    value = node["value"].replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r")
+    if "xml:lang" in node:
+        return f'"{value}"@{node["xml:lang"]}'
+    if "datatype" in node:
+        return f'"{value}"^^<{node["datatype"]}>'
+    return f'"{value}"'
+
+
+def _strip_disambiguation(name: str) -> str:
+    """Drops a trailing disambiguation such as the "(planet)" of "Mercury (planet)"."""
+    return re.sub(r"\s*\([^)]*\)$", "", name)
+
+
+def _uri_surface(uri: str) -> str:
+    """The surface form of a resource taken from its URI local name, as used without a label."""
+    name = uri[len(DBR):] if uri.startswith(DBR) else uri.rsplit("/", 1)[-1]
+    return _strip_disambiguation(name.replace("_", " "))
+
+
+# Objects of `dbo:` triples that are DBpedia resources, in either form `_turtle_iri` writes them
+SWAPPABLE_OBJECT = re.compile(r"dbo:[\w-]+\s+(dbr:[\w-]+|<http://dbpedia\.org/resource/[^>\s]+>)")
+
+
+def _swappable_objects(turtle: str) -> list:
+    """URIs of the resources a negative can swap in a Turtle graph, in order of first appearance."""
+    return list(dict.fromkeys(_resource_uri(term) for term in SWAPPABLE_OBJECT.findall(turtle)))
+
+
+def _replace_term(turtle: str, old_uri: str, new_uri: str) -> str:
+    """Replaces whole occurrences of one IRI term, so `dbr:Ulm` does not also rewrite `dbr:Ulm_Minster`."""
+    return re.sub(r"(?<!\S)" + re.escape(_turtle_iri(old_uri)) + r"(?!\S)", lambda m: _turtle_iri(new_uri), turtle)
+
+
+def _resource_uri(term: str) -> str | None:
+    """The DBpedia resource IRI behind a Turtle term, or None for literals and other IRIs."""
+    if term.startswith("dbr:"):
+        return DBR + term[4:]
+    if term.startswith(f"<{DBR}"):
+        return term[1:-1]
+    return None
+
+
+class NeighbourhoodCache:
+    """Bounded LRU cache of 1-hop `dbo:` neighbourhoods, shared by every entity of a run.
+
+    An entity's 2-hop graph is its own neighbourhood plus those of its resource objects. Each
+    node is fetched once, in VALUES batches, so popular objects (countries, universities, awards)
+    are transferred once per run instead of once per entity that links to them. Neighbourhoods
+    are stored as (predicate, object) Turtle terms; the least recently used ones are evicted once
+    the cache holds more than `max_triples` triples.
+    """
+    def __init__(self, processor, max_triples: int):
+        self.processor = processor
+        self.max_triples = max_triples
+        self.nodes = OrderedDict()  # uri -> [(predicate, object)]
+        self.num_triples = 0
+        self.hits = 0
+        self.fetched = 0
+
+    def get(self, uris) -> dict | None:
+        """Returns {uri: [(predicate, object)]} for `uris`, fetching the uncached ones. None if a fetch failed."""
+        result = {}
+        missing = []
+        for uri in dict.fromkeys(uris):
+            if uri in self.nodes:
+                self.nodes.move_to_end(uri)
+                result[uri] = self.nodes[uri]
+                self.hits += 1
+            else:
+                missing.append(uri)
+        batch_size = self.processor.config["neighbourhood_batch_size"]
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            fetched = self.processor.fetch_neighbourhoods(batch)
+            if fetched is None:
+                return None
+            for uri in batch:
+                result[uri] = self.nodes[uri] = fetched.get(uri, [])
+                self.num_triples += len(result[uri])
+            self.fetched += len(batch)
+        while self.num_triples > self.max_triples and len(self.nodes) > 1:
+            _, evicted = self.nodes.popitem(last=False)
+            self.num_triples -= len(evicted)
+        return result
+
+
 class DbpediaProcessor:
     """Handles fetching details and generating negative samples for a given list of entities."""
     def __init__(self, config, verbose: bool = False):
         self.config = config
+        from SPARQLWrapper import SPARQLWrapper
         self.sparql = SPARQLWrapper(config["sparql_endpoint"], agent=config["user_agent"])
         self.sparql.setTimeout(30)
         self.verbose = verbose
+        self.labels = LabelIndex(self, fallback_lang=config["primary_language"])
+        self.neighbourhoods = NeighbourhoodCache(self, max_triples=config["neighbourhood_cache_max_triples"])
 
-    def get_entity_details(self, entity_uri: str) -> dict | None:
-        entity_name = entity_uri.split("/")[-1].replace("_", " ")
-        self.sparql.setReturnFormat(JSON)
+    def fetch_comments(self, entity_uri: str) -> dict | None:
+        """Returns {lang: comment} for comments long enough to anchor on, or None if the query failed."""
+        self.sparql.setReturnFormat('json')
         lang_query = f"""
         PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
         SELECT ?comment WHERE {{ <{entity_uri}> rdfs:comment ?comment . }}
@@ -68,221 +361,932 @@ class DbpediaProcessor:
             if self.verbose:
                 print(f"  [DEBUG] SPARQL comment query failed for {entity_uri}: {e}", flush=True)
             return None
-        
+
         multilingual_texts = {}
         for r in results["results"]["bindings"]:
             comment_node = r["comment"]
-            if "xml:lang" in comment_node and len(comment_node["value"]) > 150:
+            if "xml:lang" in comment_node and len(comment_node["value"]) > self.config["min_comment_chars"]:
                 multilingual_texts[comment_node["xml:lang"]] = comment_node["value"]
-        
-        if not multilingual_texts:
+        return multilingual_texts
+
+    def fetch_yield_stats(self, entity_uris: list) -> dict | None:
+        """Bulk-estimates how productive each entity will be, with two aggregate queries for the whole batch.
+
+        Returns {uri: {"langs": n, "swappable": m}}: the number of languages with a comment long
+        enough to anchor on, and the number of distinct `dbr:` objects of `dbo:` predicates (the
+        only triples `generate_negative_sample` can swap). Returns None if either query fails.
+        """
+        values = " ".join(f"<{uri}>" for uri in entity_uris)
+        stats = {uri: {"langs": 0, "swappable": 0} for uri in entity_uris}
+        self.sparql.setReturnFormat('json')
+
+        comment_query = f"""
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        SELECT ?s (COUNT(DISTINCT ?lang) AS ?langs) WHERE {{
+            VALUES ?s {{ {values} }}
+            ?s rdfs:comment ?c . BIND(LANG(?c) AS ?lang)
+            FILTER(?lang != "" && STRLEN(STR(?c)) > {self.config["min_comment_chars"]})
+        }} GROUP BY ?s"""
+        swap_query = f"""
+        SELECT ?s (COUNT(DISTINCT ?o) AS ?swappable) WHERE {{
+            VALUES ?s {{ {values} }}
+            ?s ?p ?o .
+            FILTER(STRSTARTS(STR(?p), "http://dbpedia.org/ontology/") && ISURI(?o) && STRSTARTS(STR(?o), "http://dbpedia.org/resource/"))
+        }} GROUP BY ?s"""
+        for query, field in ((comment_query, "langs"), (swap_query, "swappable")):
+            self.sparql.setQuery(query)
+            try:
+                bindings = self.sparql.query().convert()["results"]["bindings"]
+            except Exception as e:
+                if self.verbose:
+                    print(f"  [DEBUG] Prefilter {field} query failed for a batch of {len(entity_uris)}: {e}", flush=True)
+                return None
+            for r in bindings:
+                if r["s"]["value"] in stats:
+                    stats[r["s"]["value"]][field] = int(r[field]["value"])
+        return stats
+
+    def fetch_labels(self, entity_uris: list, langs: list) -> dict | None:
+        """Returns {uri: {lang: label}} for the given entities and languages in one query, or None on failure."""
+        values = " ".join(f"<{uri}>" for uri in entity_uris)
+        lang_list = ", ".join(f'"{lang}"' for lang in langs)
+        self.sparql.setReturnFormat('json')
+        self.sparql.setQuery(f"""
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        SELECT ?s ?label WHERE {{
+            VALUES ?s {{ {values} }}
+            ?s rdfs:label ?label . FILTER(LANG(?label) IN ({lang_list}))
+        }}""")
+        try:
+            bindings = self.sparql.query().convert()["results"]["bindings"]
+        except Exception as e:
             if self.verbose:
-                print(f"  [DEBUG] No suitable comments found for {entity_uri}", flush=True)
+                print(f"  [DEBUG] Label query failed for {len(entity_uris)} entities: {e}", flush=True)
             return None
+        labels = {}
+        for r in bindings:
+            labels.setdefault(r["s"]["value"], {})[r["label"]["xml:lang"]] = r["label"]["value"]
+        return labels
 
-        if self.verbose:
-            print(f"  [DEBUG] Found {len(multilingual_texts)} comments. Fetching RDF...", flush=True)
-        self.sparql.setReturnFormat('turtle')
+    def fetch_fingerprints(self, entity_uris: list) -> dict:
+        """Bulk-computes input fingerprints with two aggregate queries for the whole batch.
+
+        Per subject, the endpoint returns a count and an order-independent hash sum of the comments
+        `fetch_comments` keeps, and of the 2-hop `dbo:` triples `get_entity_details` assembles (the
+        entity's own and those of its `dbr:` objects). Only these aggregates are transferred. A batch
+        whose queries fail is split in half and retried; URIs that fail on their own are left out.
+        """
+        values = " ".join(f"<{uri}>" for uri in entity_uris)
+        digests = {uri: {"comments": "0:0", "rdf": "0:0"} for uri in entity_uris}
+        self.sparql.setReturnFormat('json')
+
+        comment_query = f"""
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+        SELECT ?s (COUNT(*) AS ?n) (SUM({_sparql_hash_number('CONCAT(LANG(?c), " ", STR(?c))')}) AS ?h) WHERE {{
+            VALUES ?s {{ {values} }}
+            ?s rdfs:comment ?c .
+            FILTER(LANG(?c) != "" && STRLEN(STR(?c)) > {self.config["min_comment_chars"]})
+        }} GROUP BY ?s"""
         rdf_query = f"""
-        CONSTRUCT {{ <{entity_uri}> ?p1 ?o1 . ?o1 ?p2 ?o2 . }}
-        WHERE {{
-            <{entity_uri}> ?p1 ?o1 . FILTER(STRSTARTS(STR(?p1), "http://dbpedia.org/ontology/"))
-            OPTIONAL {{ FILTER(ISURI(?o1) && STRSTARTS(STR(?o1), "http://dbpedia.org/resource/")) ?o1 ?p2 ?o2 . FILTER(STRSTARTS(STR(?p2), "http://dbpedia.org/ontology/")) }}
-        }}"""
-        self.sparql.setQuery(rdf_query)
-        try:
-            anchor_rdf = self.sparql.query().convert().decode('utf-8')
-            if not anchor_rdf:
+        PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+        SELECT ?s (COUNT(*) AS ?n) (SUM({_sparql_hash_number('CONCAT(STR(?node), " ", STR(?p), " ", STR(?o))')}) AS ?h) WHERE {{
+            SELECT DISTINCT ?s ?node ?p ?o WHERE {{
+                VALUES ?s {{ {values} }}
+                {{ ?s ?p ?o . BIND(?s AS ?node) }}
+                UNION
+                {{ ?s ?p1 ?node . ?node ?p ?o .
+                   FILTER(STRSTARTS(STR(?p1), "{DBO}") && ISURI(?node) && STRSTARTS(STR(?node), "{DBR}") && ?node != ?s) }}
+                FILTER(STRSTARTS(STR(?p), "{DBO}") && !ISBLANK(?o))
+            }}
+        }} GROUP BY ?s"""
+        for query, field in ((comment_query, "comments"), (rdf_query, "rdf")):
+            self.sparql.setQuery(query)
+            try:
+                bindings = self.sparql.query().convert()["results"]["bindings"]
+            except Exception as e:
                 if self.verbose:
-                    print(f"  [DEBUG] RDF CONSTRUCT query returned no data for {entity_uri}", flush=True)
-                return None
+                    print(f"  [DEBUG] Fingerprint {field} query failed for a batch of {len(entity_uris)}: {e}", flush=True)
+                if len(entity_uris) == 1:
+                    return {}
+                half = len(entity_uris) // 2
+                return {**self.fetch_fingerprints(entity_uris[:half]), **self.fetch_fingerprints(entity_uris[half:])}
+            for r in bindings:
+                if r["s"]["value"] in digests:
+                    digests[r["s"]["value"]][field] = f'{r["n"]["value"]}:{r.get("h", {}).get("value", "0")}'
+        return {uri: compute_input_fingerprint(d["comments"], d["rdf"]) for uri, d in digests.items()}
+
+    def fetch_neighbourhoods(self, node_uris: list) -> dict | None:
+        """Returns {uri: sorted [(predicate, object)]} of 1-hop `dbo:` triples for the given nodes, or None on failure.
+
+        A batch whose result reaches the endpoint's row limit was truncated, so it is split in half and
+        retried; a single node over the limit keeps its truncated neighbourhood.
+        """
+        values = " ".join(f"<{uri}>" for uri in node_uris)
+        self.sparql.setReturnFormat('json')
+        self.sparql.setQuery(f"""
+        SELECT ?s ?p ?o WHERE {{
+            VALUES ?s {{ {values} }}
+            ?s ?p ?o . FILTER(STRSTARTS(STR(?p), "{DBO}") && !ISBLANK(?o))
+        }}""")
+        try:
+            bindings = self.sparql.query().convert()["results"]["bindings"]
         except Exception as e:
             if self.verbose:
-                print(f"[WARN] RDF CONSTRUCT query failed for {entity_uri}: {e}", flush=True)
+                print(f"  [DEBUG] Neighbourhood query failed for {len(node_uris)} nodes: {e}", flush=True)
             return None
+        if len(bindings) >= self.config["sparql_max_rows"] and len(node_uris) > 1:
+            half = len(node_uris) // 2
+            first, second = self.fetch_neighbourhoods(node_uris[:half]), self.fetch_neighbourhoods(node_uris[half:])
+            if first is None or second is None:
+                return None
+            return {**first, **second}
+        neighbourhoods = {}
+        for r in bindings:
+            neighbourhoods.setdefault(r["s"]["value"], set()).add((_turtle_iri(r["p"]["value"]), _turtle_term(r["o"])))
+        return {uri: sorted(triples) for uri, triples in neighbourhoods.items()}
+
+    def get_entity_details(self, entity_uri: str, multilingual_texts: dict | None = None, fingerprint: str | None = None) -> dict | None:
+        """Fetches comments and assembles the 2-hop RDF graph. Already-fetched comments/fingerprint can be passed in to skip those queries.
+
+        Returns None if a query failed, and {} if the entity has no usable comments or RDF.
+        """
+        entity_name = entity_uri.split("/")[-1].replace("_", " ")
+        if multilingual_texts is None:
+            multilingual_texts = self.fetch_comments(entity_uri)
+            if multilingual_texts is None:
+                return None
+
+        if not multilingual_texts:
+            if self.verbose:
+                print(f"  [DEBUG] No suitable comments found for {entity_uri}", flush=True)
+            return {}
+
+        if fingerprint is None:
+            fingerprint = self.fetch_fingerprints([entity_uri]).get(entity_uri)
+            if fingerprint is None:
+                return None
+
+        if self.verbose:
+            print(f"  [DEBUG] Found {len(multilingual_texts)} comments. Fetching RDF...", flush=True)
+        # Only 1-hop neighbourhoods are fetched; the second hop comes from the shared cache
+        entity_hood = self.neighbourhoods.get([entity_uri])
+        if entity_hood is None:
+            if self.verbose:
+                print(f"[WARN] RDF neighbourhood query failed for {entity_uri}", flush=True)
+            return None
+        if not entity_hood[entity_uri]:
+            if self.verbose:
+                print(f"  [DEBUG] RDF query returned no data for {entity_uri}", flush=True)
+            return {}
+        objects = [uri for uri in (_resource_uri(o) for _, o in entity_hood[entity_uri]) if uri and uri != entity_uri]
+        object_hoods = self.neighbourhoods.get(objects)
+        if object_hoods is None:
+            if self.verbose:
+                print(f"[WARN] RDF neighbourhood query failed for the objects of {entity_uri}", flush=True)
+            return None
+
+        lines = []
+        for subject, triples in [(entity_uri, entity_hood[entity_uri])] + sorted(object_hoods.items()):
+            subject_term = _turtle_iri(subject)
+            lines.extend(f"{subject_term}\t{predicate}\t{obj} ." for predicate, obj in triples)
+        anchor_rdf = TURTLE_PREFIXES + "\n".join(lines[:self.config["max_rdf_triples"]]) + "\n"
         if self.verbose:
             print(f"  [DEBUG] Successfully fetched RDF for {entity_uri}", flush=True)
-        return {"uri": entity_uri, "title": entity_name, "multilingual_texts": multilingual_texts, "rdf": anchor_rdf}
+        return {"uri": entity_uri, "title": entity_name, "multilingual_texts": multilingual_texts, "rdf": anchor_rdf, "fingerprint": fingerprint}
 
-    def generate_negative_sample(self, anchor_text, anchor_rdf) -> dict | None:
-        candidate_triples = re.findall(r"(dbo:\w+\s+dbr:[\w,-]+)", anchor_rdf)
-        if not candidate_triples:
-            return None
+    def _lookup_replacements(self, original_object_uri: str) -> list:
+        """Runs the type and replacement queries for one object and returns the URIs of same-typed DBpedia resources."""
+        self.sparql.setReturnFormat('json')
 
-        # Filter for entities that are actually mentioned in the anchor text
-        mentioned_candidate_triples = []
-        for triple in candidate_triples:
-            original_object_short = triple.split()[1]
-            original_text_obj = original_object_short.split(':')[1].replace('_', ' ')
-            if re.search(re.escape(original_text_obj), anchor_text, flags=re.IGNORECASE):
-                mentioned_candidate_triples.append(triple)
+        type_query = f"SELECT ?type WHERE {{ <{original_object_uri}> a ?type . }}"
+        if self.verbose:
+            print(f"    [DEBUG-NEG] Looking up replacements for: {original_object_uri}", flush=True)
+        self.sparql.setQuery(type_query)
+        try:
+            results = self.sparql.query().convert()
+        except Exception as e:
+            if self.verbose:
+                print(f"    [DEBUG-NEG] Type query failed: {e}", flush=True)
+            return []
 
-        if not mentioned_candidate_triples:
+        types = [r["type"]["value"] for r in results["results"]["bindings"] if "ontology" in r["type"]["value"]]
+        if not types:
             if self.verbose:
-                print(f"    [DEBUG-NEG] No RDF entities were found mentioned in the text. Cannot create negative sample.", flush=True)
-            return None
-        
-        for triple_to_corrupt in mentioned_candidate_triples:
-            original_object_short = triple_to_corrupt.split()[1]
-            original_object_uri = f"http://dbpedia.org/resource/{original_object_short.split(':')[1]}"
-            self.sparql.setReturnFormat(JSON)
-            
-            type_query = f"SELECT ?type WHERE {{ <{original_object_uri}> a ?type . }}"
+                print(f"    [DEBUG-NEG] No ontology types found for {original_object_uri}", flush=True)
+            return []
+
+        target_type = random.choice(types)
+        replacement_query = f"""SELECT ?replacement WHERE {{ ?replacement a <{target_type}> . FILTER(?replacement != <{original_object_uri}>) }} LIMIT 10"""
+        if self.verbose:
+            print(f"    [DEBUG-NEG] Finding replacement of type {target_type}", flush=True)
+        self.sparql.setQuery(replacement_query)
+        try:
+            results = self.sparql.query().convert()
+        except Exception as e:
             if self.verbose:
-                print(f"    [DEBUG-NEG] Attempting to replace: {original_object_uri}", flush=True)
-            self.sparql.setQuery(type_query)
-            try:
-                results = self.sparql.query().convert()
-            except Exception as e:
-                if self.verbose:
-                    print(f"    [DEBUG-NEG] Type query failed: {e}", flush=True)
-                continue # Try next candidate triple
+                print(f"    [DEBUG-NEG] Replacement query failed: {e}", flush=True)
+            return []
 
-            types = [r["type"]["value"] for r in results["results"]["bindings"] if "ontology" in r["type"]["value"]]
-            if not types:
-                if self.verbose:
-                    print(f"    [DEBUG-NEG] No ontology types found for {original_object_uri}", flush=True)
-                continue # Try next candidate triple
-            
-            target_type = random.choice(types)
-            replacement_query = f"""SELECT ?replacement WHERE {{ ?replacement a <{target_type}> . FILTER(?replacement != <{original_object_uri}>) }} LIMIT 10"""
+        replacements = [r["replacement"]["value"] for r in results["results"]["bindings"] if r["replacement"]["value"].startswith(DBR)]
+        if not replacements and self.verbose:
+            print(f"    [DEBUG-NEG] No replacement entities found.", flush=True)
+        return replacements
+
+    def generate_negative_samples(self, anchor_text, anchor_rdf, k: int = 1, max_swaps: int = 1, swap_pool: dict | None = None,
+                                  lang: str | None = None, labels: LabelIndex | None = None) -> list:
+        """Generates up to `k` distinct negatives for one anchor, each swapping 1..`max_swaps` entities.
+
+        Type/replacement lookups are done at most once per swappable object and stored in `swap_pool`
+        ({object uri: [replacement uris]}). Passing the same dict for every anchor text of an
+        entity shares those lookups across languages. Each negative reports how many entities were
+        swapped and a difficulty label: fewer swaps stay closer to the anchor and are harder.
+
+        With a `labels` index, entities are found and replaced in the text by their `lang` label
+        instead of the English URI local name; replacements without a label in `lang` are skipped.
+        Missing labels are fetched here in bulk, so callers need not prefetch them.
+        """
+        if swap_pool is None:
+            swap_pool = {}
+        if labels is None:
+            surface = _uri_surface
+        else:
+            def surface(uri):
+                return labels.surface(uri, lang)
+        candidates = _swappable_objects(anchor_rdf)
+        if not candidates:
+            return []
+        if labels is not None and lang is not None:
+            labels.ensure(candidates, [lang])
+
+        # Objects that are actually mentioned (as whole words) in the anchor text, in random order
+        mentioned = {}
+        for original_object_uri in candidates:
+            original_text_obj = surface(original_object_uri)
+            if original_text_obj and re.search(_surface_pattern(original_text_obj, lang), anchor_text, flags=re.IGNORECASE):
+                mentioned[original_object_uri] = original_text_obj
+        if not mentioned:
             if self.verbose:
-                print(f"    [DEBUG-NEG] Finding replacement of type {target_type}", flush=True)
-            self.sparql.setQuery(replacement_query)
-            try:
-                results = self.sparql.query().convert()
-            except Exception as e:
-                if self.verbose:
-                    print(f"    [DEBUG-NEG] Replacement query failed: {e}", flush=True)
-                continue # Try next candidate triple
+                print(f"    [DEBUG-NEG] No RDF entities were found mentioned in the text. Cannot create negative sample.", flush=True)
+            return []
+        order = list(mentioned)
+        random.shuffle(order)
 
-            if not results["results"]["bindings"]:
-                if self.verbose:
-                    print(f"    [DEBUG-NEG] No replacement entities found.", flush=True)
-                continue # Try next candidate triple
-                
-            replacement_uri = random.choice(results["results"]["bindings"])["replacement"]["value"]
-            replacement_short = f"dbr:{replacement_uri.split('/')[-1]}"
-            negative_rdf = anchor_rdf.replace(original_object_short, replacement_short)
-            
-            original_text_obj = original_object_short.split(':')[1].replace('_', ' ')
-            replacement_text_obj = replacement_short.split(':')[1].replace('_', ' ')
-            
-            # Use case-insensitive regex replacement with word boundaries and check if substitution happened
-            negative_text, count = re.subn(r'\b' + re.escape(original_text_obj) + r'\b', replacement_text_obj, anchor_text, flags=re.IGNORECASE)
-            
-            if count > 0:
-                if self.verbose:
-                    print(f"    [DEBUG-NEG] Successfully replaced '{original_text_obj}' with '{replacement_text_obj}'", flush=True)
-                return {"text": negative_text, "rdf": negative_rdf}
-            else:
-                if self.verbose:
-                    print(f"    [DEBUG-NEG] Text replacement failed for '{original_text_obj}'. Trying next candidate.", flush=True)
+        # Resolve only as many objects as are needed to build k negatives with up to max_swaps swaps
+        usable = []
+        for original_object_uri in order:
+            if original_object_uri not in swap_pool:
+                swap_pool[original_object_uri] = self._lookup_replacements(original_object_uri)
+            if swap_pool[original_object_uri]:
+                usable.append(original_object_uri)
+            if len(usable) >= max_swaps and sum(len(swap_pool[o]) for o in usable) >= k:
+                break
+        if labels is not None:
+            labels.ensure({r for o in usable for r in swap_pool[o]}, [lang])
+        choices = {o: [r for r in swap_pool[o] if surface(r)] for o in usable}
+        usable = [o for o in usable if choices[o]]
+        if not usable:
+            return []
 
-        # If loop finishes without success
-        return None
+        negatives = []
+        seen_texts = set()
+        for attempt in range(k * 5):
+            if len(negatives) >= k:
+                break
+            num_swaps = min(1 + attempt % max_swaps, len(usable))
+            negative_rdf, negative_text = anchor_rdf, anchor_text
+            swaps = []
+            for original_object_uri in random.sample(usable, num_swaps):
+                replacement_uri = random.choice(choices[original_object_uri])
+                replacement_text_obj = surface(replacement_uri)
+                negative_text, count = re.subn(_surface_pattern(mentioned[original_object_uri], lang), lambda m: replacement_text_obj, negative_text, flags=re.IGNORECASE)
+                if count == 0:
+                    break
+                negative_rdf = _replace_term(negative_rdf, original_object_uri, replacement_uri)
+                swaps.append((original_object_uri, replacement_uri))
+            if len(swaps) != num_swaps or negative_text in seen_texts:
+                continue
+            seen_texts.add(negative_text)
+            if self.verbose:
+                print(f"    [DEBUG-NEG] Built negative with swaps {swaps}", flush=True)
+            negatives.append({"text": negative_text, "rdf": negative_rdf, "swaps": swaps,
+                              "num_swaps": num_swaps, "difficulty": negative_difficulty(num_swaps)})
+        return negatives
 
+    def generate_negative_sample(self, anchor_text, anchor_rdf) -> dict | None:
+        """Single-negative convenience wrapper around `generate_negative_samples`."""
+        negatives = self.generate_negative_samples(anchor_text, anchor_rdf, k=1, max_swaps=1)
+        if not negatives:
+            return None
+        return {"text": negatives[0]["text"], "rdf": negatives[0]["rdf"]}
 
-def save_to_iceberg(data: list, table_name: str, s3_warehouse_path: str):
-    """Saves the processed data to an Iceberg table in S3 using the AWS Glue catalog."""
-    if not data:
-        print("[ERROR] No data generated. Aborting Iceberg write.")
-        return
-    
-    print(f"\n[INFO] Saving {len(data)} rows to Iceberg table '{table_name}' at '{s3_warehouse_path}'...")
-    df = pd.DataFrame(data)
-    schema = pa.schema([ pa.field("anchor_text", pa.string()), pa.field("anchor_rdf", pa.string()), pa.field("positive_text", pa.string()), pa.field("negative_text", pa.string()), pa.field("negative_rdf", pa.string()), pa.field("subject_uri", pa.string()), pa.field("subject_uri_id", pa.int64()) ])
-    arrow_table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
-    
+
+def prefilter_entities(processor: DbpediaProcessor, entity_uris, batch_size: int, keep: set = frozenset(), profiler=NULL_PROFILER):
+    """Drops entities that cannot yield a row and yields the rest, most productive first within each batch.
+
+    Works on any iterable (including a followed JSONL stream) one batch at a time. URIs in `keep`
+    always pass (a refresh must see them to delete their stale rows), and a batch whose aggregate
+    queries fail is passed through unfiltered.
+    """
+    def flush(batch):
+        with profiler.stage("prefilter"):
+            stats = processor.fetch_yield_stats(batch)
+        if stats is None:
+            return batch
+        survivors = [uri for uri in batch if uri in keep or (stats[uri]["langs"] and stats[uri]["swappable"])]
+        print(f"[PREFILTER] Kept {len(survivors)} of {len(batch)} entities.", flush=True)
+        return sorted(survivors, key=lambda uri: stats[uri]["langs"] * min(stats[uri]["swappable"], 10), reverse=True)
+
+    batch = []
+    for uri in entity_uris:
+        batch.append(uri)
+        if len(batch) >= batch_size:
+            yield from flush(batch)
+            batch = []
+    if batch:
+        yield from flush(batch)
+
+
+def fingerprint_entities(processor: DbpediaProcessor, entity_uris, batch_size: int, profiler=NULL_PROFILER):
+    """Yields (uri, input fingerprint) for any iterable of URIs, fingerprinting one batch at a time.
+
+    The fingerprint is None when its queries failed: nothing is known about that entity then.
+    """
+    def flush(batch):
+        with profiler.stage("fingerprint"):
+            fingerprints = processor.fetch_fingerprints(batch)
+        return [(uri, fingerprints.get(uri)) for uri in batch]
+
+    batch = []
+    for uri in entity_uris:
+        batch.append(uri)
+        if len(batch) >= batch_size:
+            yield from flush(batch)
+            batch = []
+    if batch:
+        yield from flush(batch)
+
+
+def build_entity_rows(processor: DbpediaProcessor, details: dict, verbose: bool = False, llm_texts: list | None = None) -> list:
+    """Turns one entity's details into triplet rows (one per anchor text and generated negative).
+
+    `llm_texts` are the entity's associative texts from a batch augmentation pass; without them the
+    placeholder `generate_llm_associations` is used.
+    """
+    rows = []
+    texts_to_process = list(details["multilingual_texts"].items())
+    primary_text = details["multilingual_texts"].get(CONFIG["primary_language"])
+    if primary_text:
+        if llm_texts is None:
+            llm_texts = generate_llm_associations(details["title"], primary_text)
+        for text in llm_texts:
+            texts_to_process.append((f"{CONFIG['primary_language']}_llm_assoc", text))
+
+    swap_pool = {}  # Shared by all anchor texts of this entity, so each object is looked up once
+    # One bulk label lookup for every swappable object in every language this entity has text in
+    objects = _swappable_objects(details["rdf"])
+    processor.labels.ensure(objects, {lang_code.split("_")[0] for lang_code, _ in texts_to_process})
+    for lang_code, anchor_text in texts_to_process:
+        positive_text = generate_paraphrase(anchor_text)
+        if verbose:
+            print(f"  [DEBUG] Generating negative samples for lang '{lang_code}'...", flush=True)
+        negatives = processor.generate_negative_samples(
+            anchor_text, details["rdf"], k=CONFIG["negatives_per_anchor"],
+            max_swaps=CONFIG["max_swaps_per_negative"], swap_pool=swap_pool,
+            lang=lang_code.split("_")[0], labels=processor.labels)
+
+        if negatives:
+            if verbose:
+                print(f"  [DEBUG] {len(negatives)} negative samples generated.", flush=True)
+            for negative_data in negatives:
+                rows.append({
+                    "anchor_text": anchor_text, "anchor_rdf": details["rdf"], "positive_text": positive_text,
+                    "negative_text": negative_data["text"], "negative_rdf": negative_data["rdf"],
+                    # The id is assigned from the uri_to_id table when the rows are written
+                    "subject_uri": details["uri"], "subject_uri_id": None, "lang_code": lang_code,
+                    "input_fingerprint": details["fingerprint"],
+                    "negative_swaps": negative_data["num_swaps"], "negative_difficulty": negative_data["difficulty"],
+                })
+        else:
+            if verbose:
+                print(f"  [DEBUG] Failed to generate negative sample.", flush=True)
+    return rows
+
+
+def load_glue_catalog(s3_warehouse_path: str):
     catalog_properties = {
         "type": "glue",
         "warehouse": s3_warehouse_path,
     }
+    from pyiceberg.catalog import load_catalog
     # Assumes AWS credentials are configured in the environment (e.g., via `aws configure`)
-    catalog = load_catalog("aws", **catalog_properties)
+    return load_catalog("aws", **catalog_properties)
 
+
+def ensure_namespace(catalog, table_name: str):
     if '.' in table_name:
         namespace = table_name.rsplit('.', 1)[0]
         # In Glue, namespaces are databases.
-        databases = [db['Name'] for db in catalog.list_namespaces()]
+        databases = ['.'.join(ns) if isinstance(ns, tuple) else ns for ns in catalog.list_namespaces()]
         if namespace not in databases:
             print(f"[INFO] Creating Glue database (namespace): {namespace}")
             catalog.create_namespace(namespace)
 
+
+def apply_table_layout(tx):
+    """Adds whatever the table is missing of the partition spec, sort order and metrics properties."""
+    from pyiceberg.transforms import BucketTransform, IdentityTransform
+    metadata = tx.table_metadata
+    partition_names = {f.name for f in metadata.spec().fields}
+    if not {"subject_uri_id_bucket", "lang_code"} <= partition_names:
+        with tx.update_spec() as spec:
+            if "subject_uri_id_bucket" not in partition_names:
+                spec.add_field("subject_uri_id", BucketTransform(CONFIG["subject_buckets"]), "subject_uri_id_bucket")
+            if "lang_code" not in partition_names:
+                spec.add_identity("lang_code")
+    if metadata.sort_order().is_unsorted:
+        with tx.update_sort_order() as order:
+            for column, _ in SORT_COLUMNS:
+                order.asc(column, IdentityTransform())
+    outdated = {key: value for key, value in table_properties().items() if metadata.properties.get(key) != value}
+    if outdated:
+        tx.set_properties(outdated)
+
+
+def open_or_create_table(catalog, table_name: str):
+    """Loads the table (adding any columns and layout it is missing) or creates it. Never drops existing data.
+
+    A table created before partitioning keeps its old files under the old spec; new writes use the new one.
+    """
+    ensure_namespace(catalog, table_name)
+    if not catalog.table_exists(table_name):
+        with catalog.create_table_transaction(table_name, triplet_schema()) as tx:
+            apply_table_layout(tx)
+        return catalog.load_table(table_name)
+    iceberg_table = catalog.load_table(table_name)
+    with iceberg_table.transaction() as tx:
+        if {f.name for f in triplet_schema()} - {f.name for f in iceberg_table.schema().fields}:
+            with tx.update_schema() as update:
+                update.union_by_name(triplet_schema())
+        apply_table_layout(tx)
+    return iceberg_table
+
+
+def to_arrow_table(data: list):
+    """Builds the Arrow table for `data`, sorted in the table's sort order."""
+    import pyarrow as pa
+    return pa.Table.from_pylist(data, schema=triplet_schema()).sort_by(SORT_COLUMNS)
+
+
+def load_subject_ids(catalog, table_name: str, triplet_table_name: str) -> dict:
+    """Reads {subject_uri: subject_uri_id} from the uri_to_id table.
+
+    Without that table, the allocations are seeded from the triplet table's own ids, so a table
+    written before the mapping existed keeps its class ids. Ids that do not form a one-to-one dense
+    mapping cannot be seeded; the subjects then get new ids as they are regenerated.
+    """
     if catalog.table_exists(table_name):
-        print(f"[WARN] Table {table_name} already exists. Dropping and recreating.")
-        catalog.drop_table(table_name)
-    iceberg_table = catalog.create_table(table_name, schema)
-    iceberg_table.append(arrow_table)
+        columns = catalog.load_table(table_name).scan(selected_fields=("subject_uri", "subject_uri_id")).to_arrow()
+        return dict(zip(columns.column("subject_uri").to_pylist(), columns.column("subject_uri_id").to_pylist()))
+    if not catalog.table_exists(triplet_table_name):
+        return {}
+    columns = catalog.load_table(triplet_table_name).scan(selected_fields=("subject_uri", "subject_uri_id")).to_arrow()
+    pairs = set(zip(columns.column("subject_uri").to_pylist(), columns.column("subject_uri_id").to_pylist()))
+    ids = dict(pairs)
+    if len(ids) != len(pairs) or len(set(ids.values())) != len(ids) or any(i is None or not 0 <= i < 2**31 for i in ids.values()):
+        print(f"[WARN] Existing subject_uri_id values in '{triplet_table_name}' are not a dense one-to-one mapping; not seeding '{table_name}' from them.")
+        return {}
+    print(f"[INFO] Seeding '{table_name}' with the {len(ids)} ids already used in '{triplet_table_name}'.")
+    return dict(sorted(ids.items(), key=lambda item: item[1]))
+
+
+def allocate_subject_ids(uris, table_name: str, triplet_table_name: str, s3_warehouse_path: str) -> dict:
+    """Returns {uri: subject_uri_id} for `uris`, allocating the next free ids to subjects seen for the first time.
+
+    Ids are dense and never reused or changed, so they can index the classification head. New
+    allocations are persisted before any row refers to them. Only one process may allocate at a
+    time: the full or refresh run, or the coordinator of a sharded run.
+    """
+    import datetime
+    import pyarrow as pa
+    uris = list(dict.fromkeys(uris))
+    catalog = load_glue_catalog(s3_warehouse_path)
+    ensure_namespace(catalog, table_name)
+    seeded = not catalog.table_exists(table_name)
+    known = load_subject_ids(catalog, table_name, triplet_table_name)
+    new = {}
+    next_id = max(known.values(), default=-1) + 1
+    for uri in uris:
+        if uri not in known:
+            new[uri] = next_id
+            next_id += 1
+    to_write = {**known, **new} if seeded else new
+    if to_write:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        arrow_table = pa.table({
+            "subject_uri": pa.array(list(to_write), pa.string()),
+            "subject_uri_id": pa.array(list(to_write.values()), pa.int64()),
+            "mapping_timestamp": pa.array([now] * len(to_write), pa.timestamp("us", tz="UTC")),
+        })
+        catalog.create_table_if_not_exists(table_name, schema=arrow_table.schema).append(arrow_table)
+    if new:
+        print(f"[INFO] Allocated subject_uri_id {next_id - len(new)}..{next_id - 1} to {len(new)} new subjects in '{table_name}'.")
+    return {uri: known[uri] if uri in known else new[uri] for uri in uris}
+
+
+def assign_subject_ids(data: list, s3_warehouse_path: str):
+    """Fills `subject_uri_id` of every row from the uri_to_id table, allocating ids for new subjects in row order."""
+    ids = allocate_subject_ids((row["subject_uri"] for row in data), CONFIG["uri_id_table_name"],
+                               CONFIG["iceberg_table_name"], s3_warehouse_path)
+    for row in data:
+        row["subject_uri_id"] = ids[row["subject_uri"]]
+
+
+def save_to_iceberg(data: list, table_name: str, s3_warehouse_path: str):
+    """Saves the processed data to an Iceberg table in S3 using the AWS Glue catalog.
+
+    The table contents are replaced in a single overwrite snapshot rather than by dropping the
+    table, so concurrent readers never see it missing.
+    """
+    if not data:
+        print("[ERROR] No data generated. Aborting Iceberg write.")
+        return
+    
+    print(f"\n[INFO] Saving {len(data)} rows to Iceberg table '{table_name}' at '{s3_warehouse_path}'...")
+    assign_subject_ids(data, s3_warehouse_path)
+    arrow_table = to_arrow_table(data)
+
+    catalog = load_glue_catalog(s3_warehouse_path)
+    iceberg_table = open_or_create_table(catalog, table_name)
+    iceberg_table.overwrite(arrow_table)
     print("[SUCCESS] Data successfully written to Iceberg table in S3 with AWS Glue catalog.")
 
 
-def main():
+def load_existing_fingerprints(table_name: str, s3_warehouse_path: str, fingerprint_table_name: str | None = None) -> dict:
+    """Reads {subject_uri: input_fingerprint} from the fingerprint table and the triplet table, projecting only those two columns.
+
+    The fingerprint table also covers subjects that yielded no rows; the triplet table's own
+    column covers rows written before that table existed.
+    """
+    catalog = load_glue_catalog(s3_warehouse_path)
+    fingerprints = {}
+    for name in (table_name, fingerprint_table_name):
+        if not name or not catalog.table_exists(name):
+            continue
+        iceberg_table = catalog.load_table(name)
+        if "input_fingerprint" not in {f.name for f in iceberg_table.schema().fields}:
+            print(f"[WARN] Table {name} has no fingerprints yet; its entities will be regenerated.")
+            continue
+        columns = iceberg_table.scan(selected_fields=("subject_uri", "input_fingerprint")).to_arrow()
+        fingerprints.update(zip(columns.column("subject_uri").to_pylist(), columns.column("input_fingerprint").to_pylist()))
+    return fingerprints
+
+
+def save_fingerprints(fingerprints: dict, table_name: str, s3_warehouse_path: str, replace_all: bool):
+    """Records the fingerprint of every processed subject, replacing all rows or only those of `fingerprints`.
+
+    Called after the triplet table is written, so a stored fingerprint never describes rows that
+    were not committed.
+    """
+    if not fingerprints:
+        return
+    import pyarrow as pa
+    from pyiceberg.expressions import AlwaysTrue, In
+    catalog = load_glue_catalog(s3_warehouse_path)
+    ensure_namespace(catalog, table_name)
+    arrow_table = pa.table({"subject_uri": list(fingerprints), "input_fingerprint": list(fingerprints.values())})
+    iceberg_table = catalog.create_table_if_not_exists(table_name, schema=arrow_table.schema)
+    iceberg_table.overwrite(arrow_table, overwrite_filter=AlwaysTrue() if replace_all else In("subject_uri", list(fingerprints)))
+    print(f"[INFO] Recorded fingerprints for {len(fingerprints)} entities in '{table_name}'.")
+
+
+def upsert_to_iceberg(data: list, changed_uris: list, table_name: str, s3_warehouse_path: str):
+    """Replaces the rows of `changed_uris` with `data` in a single overwrite, leaving all other subjects untouched."""
+    if not changed_uris:
+        print("[INFO] No entities changed. Nothing to commit.")
+        return
+
+    catalog = load_glue_catalog(s3_warehouse_path)
+    iceberg_table = open_or_create_table(catalog, table_name)
+
+    print(f"\n[INFO] Replacing rows for {len(changed_uris)} changed entities with {len(data)} new rows in '{table_name}'...")
+    from pyiceberg.expressions import In
+    # Matched on the URI alone, so rows are replaced whatever id they were written with
+    changed_filter = In("subject_uri", changed_uris)
+    if data:
+        assign_subject_ids(data, s3_warehouse_path)
+        arrow_table = to_arrow_table(data)
+        iceberg_table.overwrite(arrow_table, overwrite_filter=changed_filter)
+    else:
+        iceberg_table.delete(delete_filter=changed_filter)
+    print("[SUCCESS] Changed entities committed to Iceberg table.")
+
+
+# --- Sharded generation ---
+# Workers never touch the table: each writes one Parquet data file plus a small JSON manifest
+# under `<staging_dir>/<run_id>/`, named after its shard, so rerunning a shard just replaces its
+# own files. The coordinator (`--commit-shards`) appends all staged files in one transaction,
+# which rewrites them into the table's partitions.
+
+def _staging_fs(uri: str):
+    import pyarrow.fs as pafs
+    if "://" not in uri:
+        uri = os.path.abspath(uri)
+    return pafs.FileSystem.from_uri(uri)
+
+
+def _shard_name(shard_index: int, num_shards: int) -> str:
+    return f"shard-{shard_index:05d}-of-{num_shards:05d}"
+
+
+def stage_shard(data: list, changed_uris: list, staging_dir: str, run_id: str, shard_index: int, num_shards: int, fingerprints: dict | None = None):
+    """Writes this worker's rows and manifest to the staging area, replacing any earlier attempt of the same shard.
+
+    Rows are staged without `subject_uri_id`; the coordinator allocates ids for all shards at once.
+    """
+    import pyarrow.parquet as pq
+    run_uri = f"{staging_dir.rstrip('/')}/{run_id}"
+    fs, run_path = _staging_fs(run_uri)
+    fs.create_dir(run_path, recursive=True)
+    name = _shard_name(shard_index, num_shards)
+
+    arrow_table = to_arrow_table(data)
+    data_path = f"{run_path}/{name}.parquet"
+    pq.write_table(arrow_table, f"{data_path}.tmp", filesystem=fs)
+    fs.move(f"{data_path}.tmp", data_path)
+
+    # The manifest is written last: its presence marks the shard as complete.
+    manifest = {"shard_index": shard_index, "num_shards": num_shards, "rows": len(data),
+                "data_file": f"{run_uri}/{name}.parquet", "changed_uris": changed_uris, "fingerprints": fingerprints or {},
+                "subjects": list(dict.fromkeys(row["subject_uri"] for row in data))}
+    with fs.open_output_stream(f"{run_path}/{name}.json") as f:
+        f.write(json.dumps(manifest).encode("utf-8"))
+    print(f"[SUCCESS] Staged {len(data)} rows for {name} at '{run_uri}'.")
+
+
+def commit_staged_shards(staging_dir: str, run_id: str, num_shards: int, refresh: bool, table_name: str, s3_warehouse_path: str) -> bool:
+    """Appends every staged shard of `run_id` to the table in a single transaction.
+
+    Refuses to commit while shards are missing, and refuses to commit the same run twice.
+    A full run replaces all table rows; a refresh run replaces only the rows of changed subjects.
+    """
+    import pyarrow as pa
+    import pyarrow.fs as pafs
+    import pyarrow.parquet as pq
+    from pyiceberg.expressions import AlwaysTrue, In
+    run_uri = f"{staging_dir.rstrip('/')}/{run_id}"
+    fs, run_path = _staging_fs(run_uri)
+    if fs.get_file_info(f"{run_path}/_COMMITTED").type != pafs.FileType.NotFound:
+        print(f"[ERROR] Run '{run_id}' was already committed. Use a new --run-id.")
+        return False
+
+    manifests = []
+    missing = []
+    for shard_index in range(num_shards):
+        manifest_path = f"{run_path}/{_shard_name(shard_index, num_shards)}.json"
+        if fs.get_file_info(manifest_path).type == pafs.FileType.NotFound:
+            missing.append(shard_index)
+            continue
+        with fs.open_input_stream(manifest_path) as f:
+            manifests.append(json.loads(f.read().decode("utf-8")))
+    if missing:
+        print(f"[ERROR] {len(missing)} of {num_shards} shards are not staged yet: {missing[:20]}")
+        return False
+
+    data_files = [m["data_file"] for m in manifests if m["rows"] > 0]
+    changed_uris = sorted({uri for m in manifests for uri in m["changed_uris"]})
+    fingerprints = {uri: fp for m in manifests for uri, fp in m.get("fingerprints", {}).items()}
+    total_rows = sum(m["rows"] for m in manifests)
+    print(f"[INFO] Committing {total_rows} rows from {len(data_files)} data files of run '{run_id}' to '{table_name}'...")
+
+    # Allocations are persisted before the commit, so retrying a failed commit reuses the same ids.
+    # Manifests staged before they listed their subjects fall back to the changed URIs, a superset.
+    subject_ids = allocate_subject_ids((uri for m in manifests for uri in m.get("subjects", m["changed_uris"])),
+                                       CONFIG["uri_id_table_name"], table_name, s3_warehouse_path)
+    catalog = load_glue_catalog(s3_warehouse_path)
+    iceberg_table = open_or_create_table(catalog, table_name)
+    with iceberg_table.transaction() as tx:
+        if not refresh:
+            tx.delete(delete_filter=AlwaysTrue())
+        elif changed_uris:
+            tx.delete(delete_filter=In("subject_uri", changed_uris))
+        # Staged files mix every bucket and language, so they are rewritten into partitions rather
+        # than registered as-is with add_files; one shard is read at a time to bound memory
+        for data_file in data_files:
+            file_fs, file_path = _staging_fs(data_file)
+            staged = pq.read_table(file_path, filesystem=file_fs)
+            ids = pa.array([subject_ids[uri] for uri in staged.column("subject_uri").to_pylist()], pa.int64())
+            staged = staged.set_column(staged.schema.get_field_index("subject_uri_id"), "subject_uri_id", ids)
+            tx.append(staged.sort_by(SORT_COLUMNS))
+    save_fingerprints(fingerprints, CONFIG["fingerprint_table_name"], s3_warehouse_path, replace_all=not refresh)
+
+    with fs.open_output_stream(f"{run_path}/_COMMITTED") as f:
+        f.write(str(iceberg_table.refresh().current_snapshot().snapshot_id).encode("utf-8"))
+    print(f"[SUCCESS] Run '{run_id}' committed.")
+    return True
+
+
+def main(argv=None):
     """Main execution function to run the data generation pipeline from a file."""
     parser = argparse.ArgumentParser(description="Generate a dataset from a list of DBpedia entity URIs.")
-    parser.add_argument("--input", type=str, default="physics_entities.json", help="The input JSON file containing the list of URIs.")
+    parser.add_argument("--input", type=str, default="physics_entities.json", help="The input JSON list or discovery JSONL file of URIs.")
+    parser.add_argument("--follow", action="store_true", help="Tail a JSONL input while discovery is still writing it (waiting for it to be created), until discovery finishes.")
+    parser.add_argument("--follow-timeout", type=float, default=1800, help="With --follow, give up without writing anything if the input does not grow for this many seconds (0 waits forever).")
+    parser.add_argument("--refresh", action="store_true", help="Only regenerate entities whose usable comments or 2-hop dbo: RDF changed since the last run (compared with bulk aggregate queries), and upsert them.")
+    parser.add_argument("--prefilter", action="store_true", help="Drop entities without usable comments or swappable triples using cheap bulk queries before enrichment.")
+    parser.add_argument("--negatives-per-anchor", type=int, default=CONFIG["negatives_per_anchor"], help="How many distinct negatives to generate per anchor text.")
+    parser.add_argument("--max-swaps", type=int, default=CONFIG["max_swaps_per_negative"], help="Maximum number of entities swapped in a single negative.")
+    parser.add_argument("--tokenizer", type=str, default=None, help="Also write linearized RDF and token id columns using this local tokenizer: 'bytes', 'tokenizers:<tokenizer.json>', 'transformers:<dir>' or '<module>:<factory>'.")
+    parser.add_argument("--tokenize-workers", type=int, default=os.cpu_count() or 1, help="Processes used by the --tokenizer stage.")
+    parser.add_argument("--llm-backend", type=str, default=None, help="Generate the associative texts with an LLM, several entities per request: 'mock', 'mock:<fail_rate>', 'gemini', 'gemini:<model>' or '<module>:<factory>'.")
+    parser.add_argument("--llm-pack-size", type=int, default=CONFIG["llm_pack_size"], help="Entities packed into one LLM request.")
+    parser.add_argument("--llm-concurrency", type=int, default=CONFIG["llm_concurrency"], help="LLM requests in flight at once.")
+    parser.add_argument("--num-shards", type=int, default=1, help="Total number of shards the URI list is split into (by URI hash).")
+    parser.add_argument("--shard-index", type=int, default=None, help="Run as a worker for this shard and stage its data files instead of writing the table.")
+    parser.add_argument("--run-id", type=str, default=None, help="Identifies a sharded run; all workers and the coordinator must use the same value.")
+    parser.add_argument("--commit-shards", action="store_true", help="Run as the coordinator: commit all staged shards of --run-id to the table.")
+    parser.add_argument("--profile", type=str, nargs="?", const="profile", default=None, metavar="DIR", help="Profile each pipeline stage (CPU samples, wall/CPU time) and write reports plus a flame-graph collapsed-stack file to DIR.")
+    parser.add_argument("--profile-memory", action="store_true", help="With --profile, also trace allocations during one call in 50 of each stage (slows those calls several times).")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose debug logging.")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.negatives_per_anchor < 1:
+        parser.error("--negatives-per-anchor must be at least 1.")
+    if args.max_swaps < 1:
+        parser.error("--max-swaps must be at least 1.")
+
+    CONFIG["negatives_per_anchor"] = args.negatives_per_anchor
+    CONFIG["max_swaps_per_negative"] = args.max_swaps
+    CONFIG["llm_pack_size"] = args.llm_pack_size
+    CONFIG["llm_concurrency"] = args.llm_concurrency
+
+    sharded = args.shard_index is not None or args.commit_shards
+    if sharded and not args.run_id:
+        parser.error("--run-id is required for --shard-index and --commit-shards.")
+    if args.shard_index is not None and not 0 <= args.shard_index < args.num_shards:
+        parser.error("--shard-index must be in [0, --num-shards).")
+
+    if args.commit_shards:
+        commit_staged_shards(CONFIG["staging_dir"], args.run_id, args.num_shards, args.refresh,
+                             CONFIG["iceberg_table_name"], CONFIG["s3_warehouse"])
+        return
 
     print("--- Starting Dataset Generation from URI List ---")
     
     # --- PHASE 1: Load Entity URIs from File ---
-    if not os.path.exists(args.input):
+    if not args.follow and not os.path.exists(args.input):
         print(f"[FATAL] Input file not found: {args.input}")
         print("Please run 'discover_entities.py' first to generate this file.")
         return
     
-    with open(args.input, 'r', encoding='utf-8') as f:
-        all_entities = json.load(f)
-    print(f"[PHASE 1] Loaded {len(all_entities)} unique entities from '{args.input}'.")
+    if args.follow:
+        all_entities = iter_entity_uris(args.input, follow=True, idle_timeout=args.follow_timeout)
+        print(f"[PHASE 1] Following '{args.input}'; entities are processed as discovery emits them.")
+    else:
+        all_entities = list(iter_entity_uris(args.input))
+        print(f"[PHASE 1] Loaded {len(all_entities)} unique entities from '{args.input}'.")
+    if args.shard_index is not None:
+        all_entities = (uri for uri in all_entities if shard_for_uri(uri, args.num_shards) == args.shard_index)
+        print(f"[PHASE 1] Processing shard {args.shard_index}/{args.num_shards}.")
 
+    existing_fingerprints = {}
+    if args.refresh:
+        existing_fingerprints = load_existing_fingerprints(CONFIG["iceberg_table_name"], CONFIG["s3_warehouse"], CONFIG["fingerprint_table_name"])
+        print(f"[PHASE 1] Loaded fingerprints for {len(existing_fingerprints)} previously generated entities.")
+
+    profiler = StageProfiler(trace_memory=args.profile_memory).start() if args.profile else NULL_PROFILER
+    try:
+        generate(args, all_entities, existing_fingerprints, profiler)
+    except TimeoutError as e:
+        # Raised by a followed input before anything is written, so the table is left untouched
+        print(f"\n[FATAL] {e}")
+        return
+    finally:
+        if args.profile:
+            profiler.stop()
+            profiler.write_report(args.profile)
+            print(f"[INFO] Profile written to '{args.profile}' (stages.txt, top_functions.txt, top_allocations.txt, profile.collapsed).")
+
+    print("\n--- Dataset Generation Complete ---")
+
+
+def generate(args, all_entities, existing_fingerprints: dict, profiler):
+    """Phases 2 and 3: enrich each entity, build its rows, and write them out."""
+    from tqdm import tqdm
     # --- PHASE 2: Generate multilingual triplet data for each entity ---
     print("\n[PHASE 2] Processing entities to generate triplet data...")
     processor = DbpediaProcessor(CONFIG, verbose=args.verbose)
+    if args.prefilter:
+        all_entities = prefilter_entities(processor, all_entities, CONFIG["prefilter_batch_size"], keep=set(existing_fingerprints), profiler=profiler)
     final_data = []
-    uri_to_id = {uri: i for i, uri in enumerate(all_entities)}
+    changed_uris = []
+    fingerprints = {}  # Every entity processed this run, including those that yield no rows
+    unchanged = 0
+
+    augmenter = None
+    if args.llm_backend:
+        from llm_augmentation import AssociationAugmenter, load_backend
+        augmenter = AssociationAugmenter(load_backend(args.llm_backend), pack_size=CONFIG["llm_pack_size"],
+                                         concurrency=CONFIG["llm_concurrency"], max_retries=CONFIG["llm_max_retries"],
+                                         max_pack_chars=CONFIG["llm_max_pack_chars"], verbose=args.verbose)
+    pending = []  # Entity details waiting for the next packed augmentation wave
 
-    for entity_uri in tqdm(all_entities, desc="Processing Entities"):
+    def flush_pending():
+        with profiler.stage("llm_augment"):
+            primary = CONFIG["primary_language"]
+            texts = augmenter.augment([(d["uri"], d["title"], d["multilingual_texts"][primary])
+                                       for d in pending if d["multilingual_texts"].get(primary)])
+        with profiler.stage("negatives"):
+            for d in pending:
+                final_data.extend(build_entity_rows(processor, d, verbose=args.verbose, llm_texts=texts.get(d["uri"], [])))
+        pending.clear()
+
+    # Fingerprints are computed in bulk, so unchanged entities are skipped without any per-entity query
+    total = len(all_entities) if isinstance(all_entities, list) else None
+    fingerprinted = fingerprint_entities(processor, all_entities, CONFIG["fingerprint_batch_size"], profiler=profiler)
+    for entity_uri, fingerprint in tqdm(fingerprinted, total=total, desc="Processing Entities"):
         if args.verbose:
             print(f"\n[DEBUG] Processing URI: {entity_uri}", flush=True)
-        details = processor.get_entity_details(entity_uri)
-        if not details:
+        if fingerprint is None:
             if args.verbose:
-                print(f"  [DEBUG] Skipping URI: No details found.", flush=True)
+                print(f"  [DEBUG] Skipping URI: fingerprint query failed.", flush=True)
+            continue
+        if args.refresh and existing_fingerprints.get(entity_uri) == fingerprint:
+            if args.verbose:
+                print(f"  [DEBUG] Unchanged since last run, skipping.", flush=True)
+            unchanged += 1
             continue
 
-        texts_to_process = list(details["multilingual_texts"].items())
-        primary_text = details["multilingual_texts"].get(CONFIG["primary_language"])
-        if primary_text:
-            llm_texts = generate_llm_associations(details["title"], primary_text)
-            for text in llm_texts:
-                texts_to_process.append((f"{CONFIG['primary_language']}_llm_assoc", text))
+        with profiler.stage("comments"):
+            multilingual_texts = processor.fetch_comments(entity_uri)
+        if multilingual_texts is None:
+            if args.verbose:
+                print(f"  [DEBUG] Skipping URI: comment query failed.", flush=True)
+            continue
+        if not multilingual_texts and entity_uri not in existing_fingerprints:
+            # Nothing to generate or delete, but the fingerprint lets the next refresh skip it in bulk
+            fingerprints[entity_uri] = fingerprint
+            if args.verbose:
+                print(f"  [DEBUG] Skipping URI: No details found.", flush=True)
+            continue
 
-        for lang_code, anchor_text in texts_to_process:
-            positive_text = generate_paraphrase(anchor_text)
+        with profiler.stage("entity_rdf"):
+            details = processor.get_entity_details(entity_uri, multilingual_texts, fingerprint)
+        if details is None:
+            # A failed query says nothing about the entity; its existing rows must survive the upsert
             if args.verbose:
-                print(f"  [DEBUG] Generating negative sample for lang '{lang_code}'...", flush=True)
-            negative_data = processor.generate_negative_sample(anchor_text, details["rdf"])
-            
-            if negative_data:
-                if args.verbose:
-                    print(f"  [DEBUG] Negative sample generated.", flush=True)
-                final_data.append({
-                    "anchor_text": anchor_text, "anchor_rdf": details["rdf"], "positive_text": positive_text,
-                    "negative_text": negative_data["text"], "negative_rdf": negative_data["rdf"],
-                    "subject_uri": details["uri"], "subject_uri_id": uri_to_id[details["uri"]]
-                })
-            else:
-                if args.verbose:
-                    print(f"  [DEBUG] Failed to generate negative sample.", flush=True)
+                print(f"  [DEBUG] Skipping URI: enrichment query failed.", flush=True)
+            continue
+        changed_uris.append(entity_uri)
+        fingerprints[entity_uri] = fingerprint
+        if not details:
+            if args.verbose:
+                print(f"  [DEBUG] Skipping URI: No details found.", flush=True)
+            continue
+
+        if augmenter is not None:
+            pending.append(details)
+            if len(pending) >= augmenter.wave_size:
+                flush_pending()
+        else:
+            with profiler.stage("negatives"):
+                final_data.extend(build_entity_rows(processor, details, verbose=args.verbose))
         
         time.sleep(0.1) # Be kind to the public SPARQL endpoint
 
+    if augmenter is not None:
+        if pending:
+            flush_pending()
+        stats = augmenter.stats
+        print(f"[INFO] LLM augmentation: {stats['entities']} entities in {stats['requests']} requests, {stats['retried']} retried individually, {stats['failed']} without texts.")
+    hoods = processor.neighbourhoods
+    print(f"[INFO] Neighbourhood cache: {hoods.fetched} nodes fetched, {hoods.hits} served from cache, {len(hoods.nodes)} kept.")
+    if args.tokenizer and final_data:
+        print(f"\n[PHASE 2b] Linearizing RDF and tokenizing {len(final_data)} rows with '{args.tokenizer}'...")
+        with profiler.stage("tokenize"):
+            from training_columns import add_training_columns
+            unparseable = add_training_columns(final_data, args.tokenizer, max_tokens=CONFIG["max_tokens"], workers=args.tokenize_workers)
+        if unparseable:
+            print(f"[WARN] {unparseable} rows have RDF that does not parse as Turtle; their RDF token columns are null.")
+
     # --- PHASE 3: Write data to Iceberg/S3 ---
-    print(f"\n[PHASE 3] Writing {len(final_data)} total rows to S3 Iceberg warehouse...")
-    save_to_iceberg(final_data, CONFIG["iceberg_table_name"], CONFIG["s3_warehouse"])
-    
-    print("\n--- Dataset Generation Complete ---")
+    with profiler.stage("write"):
+        write_results(args, final_data, changed_uris, unchanged, fingerprints)
+
+
+def write_results(args, final_data: list, changed_uris: list, unchanged: int, fingerprints: dict):
+    """Stages a shard, upserts changed subjects, or replaces the table, depending on the run mode."""
+    if args.shard_index is not None:
+        print(f"\n[PHASE 3] Staging {len(final_data)} rows for shard {args.shard_index}...")
+        stage_shard(final_data, changed_uris, CONFIG["staging_dir"], args.run_id, args.shard_index, args.num_shards, fingerprints)
+    elif args.refresh:
+        print(f"\n[PHASE 3] {unchanged} entities unchanged, {len(changed_uris)} changed; writing {len(final_data)} rows...")
+        upsert_to_iceberg(final_data, changed_uris, CONFIG["iceberg_table_name"], CONFIG["s3_warehouse"])
+        save_fingerprints(fingerprints, CONFIG["fingerprint_table_name"], CONFIG["s3_warehouse"], replace_all=False)
+    else:
+        print(f"\n[PHASE 3] Writing {len(final_data)} total rows to S3 Iceberg warehouse...")
+        save_to_iceberg(final_data, CONFIG["iceberg_table_name"], CONFIG["s3_warehouse"])
+        if final_data:
+            save_fingerprints(fingerprints, CONFIG["fingerprint_table_name"], CONFIG["s3_warehouse"], replace_all=True)
 
 
 if __name__ == "__main__":
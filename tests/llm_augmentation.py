@@ -0,0 +1,199 @@
+
+import os
+import json
+import time
+import hashlib
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# One request carries a pack of entities; the model answers with one JSON object covering all of them
+PACKED_PROMPT = """You write short associative texts about encyclopedic entities for a training dataset.
+For EACH entity below, write exactly {num_texts} distinct texts of one to three sentences, one per perspective:
+1. its historical context, 2. what a beginner should understand first, 3. a technical deep dive,
+4. its societal impact, 5. an interesting or debated aspect.
+Use only facts supported by the description; do not mention the description itself.
+
+Respond with JSON only, in this exact shape, with one entry per entity id:
+{{"results": [{{"id": "<entity id>", "texts": ["...", "..."]}}]}}
+
+ENTITIES:
+{entities}"""
+
+
+class MockBackend:
+    """Offline backend for tests: answers packed prompts with deterministic template texts.
+
+    `fail_rate` makes that share of entities (chosen by a hash of their title) come back malformed
+    while they are packed with others, so the per-entity retry path can be exercised without a network.
+    """
+    def __init__(self, fail_rate: float = 0.0):
+        self.fail_rate = fail_rate
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def complete(self, prompt: str) -> str:
+        with self._lock:
+            self.requests += 1
+        entities = json.loads(prompt.rsplit("ENTITIES:\n", 1)[1])
+        results = []
+        for entity in entities:
+            title = entity["title"]
+            texts = [
+                f"Considering the historical context, {title} emerged as a significant concept following...",
+                f"For a beginner, the most important thing to understand about {title} is that it relates to...",
+                f"A deep technical dive into {title} reveals its dependency on the principles of...",
+                f"The societal impact of {title} can be seen in its influence on...",
+                f"An interesting and often debated aspect of {title} is...",
+            ]
+            failing = int(hashlib.md5(title.encode("utf-8")).hexdigest(), 16) % 1000 < self.fail_rate * 1000
+            if failing and len(entities) > 1:
+                texts = texts[:2]
+            results.append({"id": entity["id"], "texts": texts})
+        return "```json\n" + json.dumps({"results": results}) + "\n```"
+
+
+class GeminiBackend:
+    """Gemini in JSON mode; needs GEMINI_API_KEY."""
+    def __init__(self, model: str = "gemini-2.5-flash-lite"):
+        import google.generativeai as genai
+        if "GEMINI_API_KEY" not in os.environ:
+            raise RuntimeError("GEMINI_API_KEY environment variable not set.")
+        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+        self.model = genai.GenerativeModel(model)
+
+    def complete(self, prompt: str) -> str:
+        response = self.model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
+        return response.text
+
+
+def load_backend(spec: str):
+    """Builds an LLM backend from a spec string.
+
+    - `mock` or `mock:<fail_rate>`: offline deterministic texts (no dependencies)
+    - `gemini` or `gemini:<model>`: Google Gemini via `google-generativeai`
+    - `<module>:<factory>`: any callable returning an object with `complete(prompt: str) -> str`
+    """
+    kind, _, target = spec.partition(":")
+    if kind == "mock":
+        return MockBackend(float(target) if target else 0.0)
+    if kind == "gemini":
+        return GeminiBackend(target) if target else GeminiBackend()
+    if not target:
+        raise ValueError(f"Unknown LLM backend spec: {spec!r}")
+    return getattr(importlib.import_module(kind), target)()
+
+
+def parse_packed_response(text: str) -> dict:
+    """Returns {id: texts} from a packed response, or {} if it is not the expected JSON."""
+    cleaned = text.strip().replace("```json", "").replace("```", "").strip()
+    try:
+        results = json.loads(cleaned)["results"]
+    except (ValueError, KeyError, TypeError):
+        return {}
+    if not isinstance(results, list):
+        return {}
+    return {str(item.get("id")): item.get("texts") for item in results if isinstance(item, dict)}
+
+
+class AssociationAugmenter:
+    """Generates associative texts for many entities with few LLM requests.
+
+    Entities are packed into requests of up to `pack_size` entities and `max_pack_chars` prompt
+    characters, and `concurrency` requests run at once. Each entity's part of the response is
+    validated on its own; entities whose part is missing or malformed (or whose whole request
+    failed) are retried one per request, up to `max_retries` times, and get no texts if they never
+    validate.
+    """
+    def __init__(self, backend, num_texts: int = 5, pack_size: int = 8, concurrency: int = 4, max_retries: int = 2,
+                 max_pack_chars: int = 12000, max_description_chars: int = 1500, min_text_chars: int = 20,
+                 retry_backoff: float = 1.0, verbose: bool = False):
+        self.backend = backend
+        self.num_texts = num_texts
+        self.pack_size = pack_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.max_pack_chars = max_pack_chars
+        self.max_description_chars = max_description_chars
+        self.min_text_chars = min_text_chars
+        self.retry_backoff = retry_backoff
+        self.verbose = verbose
+        self.stats = {"requests": 0, "entities": 0, "retried": 0, "failed": 0}
+        self._lock = threading.Lock()
+
+    @property
+    def wave_size(self) -> int:
+        """Entities worth collecting before calling `augment`, so every concurrent request gets a full pack."""
+        return self.pack_size * self.concurrency
+
+    def _validate(self, texts) -> list | None:
+        if not isinstance(texts, list) or len(texts) != self.num_texts:
+            return None
+        cleaned = [t.strip() for t in texts if isinstance(t, str)]
+        if len(cleaned) != self.num_texts or len(set(cleaned)) != self.num_texts:
+            return None
+        if any(len(t) < self.min_text_chars for t in cleaned):
+            return None
+        return cleaned
+
+    def _packs(self, entries: list):
+        """Splits [(id, title, description)] into packs bounded by entity count and prompt size."""
+        pack, size = [], 0
+        for entry in entries:
+            entry_size = len(entry[1]) + len(entry[2]) + 40
+            if pack and (len(pack) >= self.pack_size or size + entry_size > self.max_pack_chars):
+                yield pack
+                pack, size = [], 0
+            pack.append(entry)
+            size += entry_size
+        if pack:
+            yield pack
+
+    def _request(self, pack: list) -> dict:
+        """Sends one packed request and returns {id: validated texts} for the entities that validated."""
+        entities = json.dumps([{"id": i, "title": title, "description": description} for i, title, description in pack], ensure_ascii=False)
+        with self._lock:
+            self.stats["requests"] += 1
+        try:
+            response = self.backend.complete(PACKED_PROMPT.format(num_texts=self.num_texts, entities=entities))
+        except Exception as e:
+            if self.verbose:
+                print(f"  [WARN] LLM request for {len(pack)} entities failed: {e}", flush=True)
+            return {}
+        parsed = parse_packed_response(response)
+        results = {}
+        for i, _, _ in pack:
+            texts = self._validate(parsed.get(i))
+            if texts is not None:
+                results[i] = texts
+        return results
+
+    def _retry_single(self, entry) -> list | None:
+        for attempt in range(self.max_retries):
+            if attempt:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            texts = self._request([entry]).get(entry[0])
+            if texts is not None:
+                return texts
+        return None
+
+    def augment(self, entities: list) -> dict:
+        """Takes [(key, title, description)] and returns {key: texts}, with [] for entities that never validated."""
+        entries = [(f"e{n}", title, (description or "")[:self.max_description_chars]) for n, (_, title, description) in enumerate(entities)]
+        keys = {entry[0]: key for entry, (key, _, _) in zip(entries, entities)}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = {}
+            for packed in pool.map(self._request, self._packs(entries)):
+                results.update(packed)
+            missing = [entry for entry in entries if entry[0] not in results]
+            for entry, texts in zip(missing, pool.map(self._retry_single, missing)):
+                if texts is not None:
+                    results[entry[0]] = texts
+        failed = sum(1 for entry in missing if entry[0] not in results)
+        with self._lock:
+            self.stats["entities"] += len(entries)
+            self.stats["retried"] += len(missing)
+            self.stats["failed"] += failed
+        if self.verbose and missing:
+            print(f"  [DEBUG] LLM augmentation: {len(missing)} entities retried individually, {failed} failed.", flush=True)
+        return {keys[i]: results.get(i, []) for i in keys}
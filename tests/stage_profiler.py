@@ -0,0 +1,191 @@
+
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class StageProfiler:
+    """Low-overhead per-stage profiler for the generation pipelines.
+
+    Code marks its stages with `with profiler.stage("name"):`. A background thread samples the
+    stacks of all threads every `interval` seconds and attributes each sample to the innermost
+    stage of that thread. Because it samples wall-clock stacks, time blocked in socket reads shows
+    up as well as CPU work. Each stage also records wall and CPU time, so the gap between them is
+    time spent waiting. With `trace_memory`, memory is tracked with tracemalloc at one frame, but only during one call
+    in `snapshot_every` of each stage: tracing slows allocation-heavy code several times, so it
+    is switched on just for those calls, which record their net traced bytes and top allocation
+    sites. Tracing is process-wide, so other threads running at the same time are slowed too and
+    can add some noise to the sampled call.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64, trace_memory: bool = False, snapshot_every: int = 50):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.trace_memory = trace_memory
+        self.snapshot_every = snapshot_every
+        self._lock = threading.Lock()
+        self._thread_stages = {}
+        self._stop = threading.Event()
+        self._sampler = None
+        self._tracing_calls = 0  # sampled stage calls currently tracing; tracemalloc runs while > 0
+        self._owns_tracing = False
+        self.collapsed = Counter()
+        self.self_samples = defaultdict(Counter)
+        self.total_samples = defaultdict(Counter)
+        self.alloc_sites = defaultdict(Counter)
+        self.stats = defaultdict(lambda: {"calls": 0, "wall": 0.0, "cpu": 0.0, "net_bytes": 0, "traced_calls": 0, "samples": 0})
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._sample_loop, name="stage-profiler", daemon=True)
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _sample_loop(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                active = {tid: stages[-1] for tid, stages in self._thread_stages.items() if stages}
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for tid, stage in active.items():
+                frame = frames.get(tid)
+                if frame is None or tid == own_ident:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                with self._lock:
+                    self.collapsed[(f"stage:{stage}",) + tuple(stack)] += 1
+                    self.self_samples[stage][stack[-1]] += 1
+                    for name in set(stack):
+                        self.total_samples[stage][name] += 1
+                    self.stats[stage]["samples"] += 1
+
+    def _start_tracing(self):
+        with self._lock:
+            if self._tracing_calls == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(1)
+                self._owns_tracing = True
+            self._tracing_calls += 1
+
+    def _stop_tracing(self):
+        with self._lock:
+            self._tracing_calls -= 1
+            if self._tracing_calls == 0 and self._owns_tracing:
+                tracemalloc.stop()
+                self._owns_tracing = False
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+
+    @contextmanager
+    def stage(self, name: str):
+        tid = threading.get_ident()
+        with self._lock:
+            traced = self.trace_memory and self.stats[name]["calls"] % self.snapshot_every == 0
+        # Tracing starts and snapshots are taken outside the stage, so their cost is not sampled or timed as part of it
+        before = None
+        if traced:
+            self._start_tracing()
+            before = self._snapshot()
+        with self._lock:
+            self._thread_stages.setdefault(tid, []).append(name)
+        mem_start = tracemalloc.get_traced_memory()[0] if traced else 0
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+            net_bytes = tracemalloc.get_traced_memory()[0] - mem_start if traced else 0
+            with self._lock:
+                self._thread_stages[tid].pop()
+            diff = []
+            if traced:
+                diff = self._snapshot().compare_to(before, "lineno")[:50]
+                self._stop_tracing()
+            with self._lock:
+                stats = self.stats[name]
+                stats["calls"] += 1
+                stats["wall"] += wall
+                stats["cpu"] += cpu
+                stats["net_bytes"] += net_bytes
+                stats["traced_calls"] += traced
+                for entry in diff:
+                    if entry.size_diff > 0:
+                        self.alloc_sites[name][str(entry.traceback[0])] += entry.size_diff
+
+    def wrap(self, name: str, fn):
+        """Returns `fn` wrapped so that every call runs inside stage `name`."""
+        def wrapped(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return wrapped
+
+    def write_report(self, out_dir: str, top_n: int = 20):
+        """Writes stages.txt, top_functions.txt, top_allocations.txt and profile.collapsed to `out_dir`."""
+        os.makedirs(out_dir, exist_ok=True)
+        with self._lock:
+            stats = {name: dict(s) for name, s in self.stats.items()}
+            collapsed = Counter(self.collapsed)
+            self_samples = {k: Counter(v) for k, v in self.self_samples.items()}
+            total_samples = {k: Counter(v) for k, v in self.total_samples.items()}
+            alloc_sites = {k: Counter(v) for k, v in self.alloc_sites.items()}
+
+        with open(os.path.join(out_dir, "stages.txt"), 'w', encoding='utf-8') as f:
+            # Net memory is only known for traced calls, so it is reported per traced call
+            f.write(f"{'stage':<24}{'calls':>9}{'wall s':>11}{'cpu s':>11}{'wait s':>11}{'net KiB/call':>14}{'samples':>10}\n")
+            for name, s in sorted(stats.items(), key=lambda kv: kv[1]["wall"], reverse=True):
+                net_per_call = s['net_bytes'] / 1024 / s['traced_calls'] if s['traced_calls'] else 0.0
+                f.write(f"{name:<24}{s['calls']:>9}{s['wall']:>11.2f}{s['cpu']:>11.2f}{max(s['wall'] - s['cpu'], 0):>11.2f}"
+                        f"{net_per_call:>14.1f}{s['samples']:>10}\n")
+
+        with open(os.path.join(out_dir, "top_functions.txt"), 'w', encoding='utf-8') as f:
+            for name in sorted(self_samples, key=lambda n: stats.get(n, {}).get("samples", 0), reverse=True):
+                samples = max(stats.get(name, {}).get("samples", 0), 1)
+                f.write(f"== {name} ({samples} samples) ==\n  self%   total%  function\n")
+                for fn, count in self_samples[name].most_common(top_n):
+                    f.write(f"  {100 * count / samples:5.1f}  {100 * total_samples[name][fn] / samples:6.1f}  {fn}\n")
+                f.write("\n")
+
+        with open(os.path.join(out_dir, "top_allocations.txt"), 'w', encoding='utf-8') as f:
+            if not self.trace_memory:
+                f.write("Memory tracing was off (enable it with --profile-memory).\n")
+            for name, sites in alloc_sites.items():
+                f.write(f"== {name} (sampled every {self.snapshot_every} calls) ==\n")
+                for site, size in sites.most_common(top_n):
+                    f.write(f"  {size / 1024:10.1f} KiB  {site}\n")
+                f.write("\n")
+
+        # Brendan Gregg's collapsed-stack format, readable by flamegraph.pl and speedscope
+        with open(os.path.join(out_dir, "profile.collapsed"), 'w', encoding='utf-8') as f:
+            for stack, count in collapsed.most_common():
+                f.write(";".join(frame.replace(";", ",") for frame in stack) + f" {count}\n")
+
+
+class NullProfiler:
+    """Stand-in used when profiling is off; stages cost a no-op context manager."""
+
+    def stage(self, name: str):
+        return nullcontext()
+
+    def wrap(self, name: str, fn):
+        return fn
+
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,163 @@
+
+import os
+import importlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+# Text and RDF fields that get token columns; RDF fields are linearized first
+TEXT_FIELDS = ("anchor_text", "positive_text", "negative_text")
+RDF_FIELDS = ("anchor_rdf", "negative_rdf")
+
+
+def training_schema_fields() -> list:
+    """Arrow fields of the training columns, appended to the triplet schema."""
+    import pyarrow as pa
+    return (
+        [pa.field(f"{name}_linear", pa.string()) for name in RDF_FIELDS]
+        + [pa.field(f"{name}_ids", pa.list_(pa.int32())) for name in TEXT_FIELDS + RDF_FIELDS]
+        + [pa.field(f"{name}_len", pa.int32()) for name in TEXT_FIELDS + RDF_FIELDS]
+    )
+
+PREFIXES = {
+    "http://dbpedia.org/resource/": "dbr:",
+    "http://dbpedia.org/ontology/": "dbo:",
+    "http://www.w3.org/1999/02/22-rdf-syntax-ns#": "rdf:",
+    "http://www.w3.org/2000/01/rdf-schema#": "rdfs:",
+}
+
+
+class ByteTokenizer:
+    """Dependency-free fallback: one id per UTF-8 byte."""
+    def encode_batch(self, texts):
+        return [list(text.encode("utf-8")) for text in texts]
+
+
+class HFTokenizersTokenizer:
+    """A local `tokenizer.json` loaded with the `tokenizers` library."""
+    def __init__(self, path: str):
+        from tokenizers import Tokenizer
+        self.tokenizer = Tokenizer.from_file(path)
+
+    def encode_batch(self, texts):
+        return [encoding.ids for encoding in self.tokenizer.encode_batch(texts)]
+
+
+class TransformersTokenizer:
+    """A tokenizer directory loaded with `transformers.AutoTokenizer`, without network access."""
+    def __init__(self, path: str):
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+
+    def encode_batch(self, texts):
+        return self.tokenizer(texts, add_special_tokens=True)["input_ids"]
+
+
+def load_tokenizer(spec: str):
+    """Builds a tokenizer from a spec string.
+
+    - `bytes`: UTF-8 byte ids (no dependencies)
+    - `tokenizers:<path/to/tokenizer.json>`: Hugging Face `tokenizers`
+    - `transformers:<local model dir>`: Hugging Face `transformers` AutoTokenizer
+    - `<module>:<factory>`: any callable returning an object with `encode_batch(list[str]) -> list[list[int]]`
+    """
+    if spec == "bytes":
+        return ByteTokenizer()
+    kind, _, target = spec.partition(":")
+    if kind == "tokenizers":
+        return HFTokenizersTokenizer(target)
+    if kind == "transformers":
+        return TransformersTokenizer(target)
+    if not target:
+        raise ValueError(f"Unknown tokenizer spec: {spec!r}")
+    return getattr(importlib.import_module(kind), target)()
+
+
+def _compact(term, max_literal_chars: int) -> str:
+    import rdflib
+    if isinstance(term, rdflib.Literal):
+        return str(term)[:max_literal_chars]
+    value = str(term)
+    for namespace, prefix in PREFIXES.items():
+        if value.startswith(namespace):
+            return prefix + value[len(namespace):]
+    return value
+
+
+def linearize_turtle(turtle: str, root: str | None = None, max_literal_chars: int = 64) -> str | None:
+    """Flattens a Turtle graph into `[S] subj [P] pred [O] obj [P] pred [O] obj ... [S] ...`.
+
+    Triples are grouped by subject with the root entity first and everything else sorted, so the
+    same graph always yields the same sequence. Returns None if the Turtle does not parse.
+    """
+    import rdflib
+    graph = rdflib.Graph()
+    try:
+        graph.parse(data=turtle, format="turtle")
+    except Exception:
+        return None
+    by_subject = defaultdict(list)
+    for s, p, o in graph:
+        by_subject[_compact(s, max_literal_chars)].append((_compact(p, max_literal_chars), _compact(o, max_literal_chars)))
+    root = _compact(rdflib.URIRef(root), max_literal_chars) if root else None
+    subjects = sorted(by_subject, key=lambda subject: (subject != root, subject))
+    parts = []
+    for subject in subjects:
+        parts.append(f"[S] {subject}")
+        for predicate, obj in sorted(by_subject[subject]):
+            parts.append(f"[P] {predicate} [O] {obj}")
+    return " ".join(parts)
+
+
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer_spec: str):
+    global _worker_tokenizer
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")  # parallelism comes from the process pool
+    _worker_tokenizer = load_tokenizer(tokenizer_spec)
+
+
+def _encode_chunk(rows: list, max_tokens: int) -> dict:
+    """Linearizes and tokenizes one chunk of rows, returning the new columns as lists.
+
+    An RDF document that does not parse gets null `_linear`, `_ids` and `_len` values rather than
+    the tokens of an empty string, so training can tell it apart from an empty graph.
+    """
+    columns = {}
+    # Rows of one entity share their anchor RDF, so each distinct document is linearized once
+    linear_cache = {}
+    for name in RDF_FIELDS:
+        linear = []
+        for row in rows:
+            key = (row[name], row.get("subject_uri"))
+            if key not in linear_cache:
+                linear_cache[key] = linearize_turtle(row[name], root=row.get("subject_uri"))
+            linear.append(linear_cache[key])
+        columns[f"{name}_linear"] = linear
+
+    for name in TEXT_FIELDS + RDF_FIELDS:
+        texts = columns[f"{name}_linear"] if name in RDF_FIELDS else [row[name] for row in rows]
+        encoded = iter(_worker_tokenizer.encode_batch([text for text in texts if text is not None]))
+        ids = [None if text is None else next(encoded)[:max_tokens] for text in texts]
+        columns[f"{name}_ids"] = ids
+        columns[f"{name}_len"] = [None if token_ids is None else len(token_ids) for token_ids in ids]
+    return columns
+
+
+def add_training_columns(rows: list, tokenizer_spec: str, max_tokens: int = 512, workers: int = 1, chunk_size: int = 256) -> int:
+    """Adds linearized RDF, token id lists and lengths to every row in place, in chunks across `workers` processes.
+
+    Returns the number of rows with an RDF field that did not parse (and so has null columns).
+    """
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    if workers <= 1:
+        _init_worker(tokenizer_spec)
+        results = [_encode_chunk(chunk, max_tokens) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(tokenizer_spec,)) as pool:
+            results = list(pool.map(_encode_chunk, chunks, [max_tokens] * len(chunks)))
+    for chunk, columns in zip(chunks, results):
+        for name, values in columns.items():
+            for row, value in zip(chunk, values):
+                row[name] = value
+    return sum(1 for row in rows if any(row[f"{name}_linear"] is None for name in RDF_FIELDS))
@@ -0,0 +1,209 @@
+
+import os
+import json
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# pyarrow is imported inside the functions that use it, so `--help` does not pay for loading it.
+
+# --- Configuration ---
+CONFIG = {
+    # Ideal anchor length range from the DataQualityMonitor design (DataGenerationPipeline_Detailed.md)
+    "min_anchor_chars": 200,
+    "max_anchor_chars": 800,
+    # Maximum allowed difference in non-ASCII character share between an anchor and its positive/negative
+    "max_script_drift": 0.2,
+    "batch_size": 8192,
+}
+
+CHECKS = ("text_length", "language", "negative_differs", "rdf_parseable")
+
+# Languages whose text is expected to be mostly non-Latin script
+NON_LATIN_LANGS = {"ar", "be", "bg", "bn", "el", "fa", "he", "hi", "hy", "ja", "ka", "ko", "mk", "ru", "sr", "ta", "th", "uk", "ur", "zh"}
+
+
+def _non_ascii_ratio(texts):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    lengths = pc.utf8_length(texts)
+    non_ascii = pc.utf8_length(pc.replace_substring_regex(texts, pattern=r"[\x00-\x7f]", replacement=""))
+    return pc.divide(pc.cast(non_ascii, pa.float64()), pc.cast(pc.max_element_wise(lengths, 1), pa.float64()))
+
+
+def _looks_like_turtle(rdf):
+    """Cheap structural test: starts like a Turtle document and ends with a statement terminator."""
+    import pyarrow.compute as pc
+    starts = pc.match_substring_regex(rdf, r"^\s*(@prefix|PREFIX|@base|<|_:|[A-Za-z][\w-]*:)")
+    ends = pc.match_substring_regex(rdf, r"\.\s*$")
+    return pc.fill_null(pc.and_(starts, ends), False)
+
+
+def _parseable_values(rdf, candidates):
+    """Fully parses each distinct RDF string among `candidates` with rdflib and returns a mask of parseable rows."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import rdflib  # Only needed for --parse-rdf
+
+    valid = []
+    for value in pc.unique(pc.filter(rdf, candidates)).to_pylist():
+        try:
+            rdflib.Graph().parse(data=value, format="turtle")
+            valid.append(value)
+        except Exception:
+            continue
+    return pc.and_(candidates, pc.is_in(rdf, value_set=pa.array(valid, type=pa.string())))
+
+
+def quality_score(batch):
+    """Vectorized form of `calculate_quality_score` from the pipeline design doc."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    rdf_lines = pc.add(pc.count_substring(batch.column("anchor_rdf"), "\n"), 1)
+    rdf_part = pc.multiply(pc.min_element_wise(pc.divide(pc.cast(rdf_lines, pa.float64()), 10.0), 1.0), 0.3)
+    length = pc.utf8_length(batch.column("anchor_text"))
+    ideal = pc.and_(pc.greater_equal(length, 100), pc.less_equal(length, 1000))
+    acceptable = pc.and_(pc.greater_equal(length, 50), pc.less_equal(length, 1500))
+    length_part = pc.if_else(ideal, 0.3, pc.if_else(acceptable, 0.2, 0.0))
+    negative_part = pc.if_else(pc.not_equal(batch.column("negative_text"), batch.column("anchor_text")), 0.4, 0.0)
+    return pc.fill_null(pc.add(pc.add(rdf_part, length_part), negative_part), 0.0)
+
+
+def validate_batch(batch: "pa.RecordBatch", parse_rdf: bool = False):
+    """Runs every check over one batch. Returns ({check: passed_rows}, row_count, filtered batch)."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    anchor = batch.column("anchor_text")
+    positive = batch.column("positive_text")
+    negative = batch.column("negative_text")
+
+    anchor_length = pc.utf8_length(anchor)
+    text_length = pc.and_(
+        pc.and_(pc.greater_equal(anchor_length, CONFIG["min_anchor_chars"]), pc.less_equal(anchor_length, CONFIG["max_anchor_chars"])),
+        pc.and_(pc.greater(pc.utf8_length(positive), 0), pc.greater(pc.utf8_length(negative), 0)),
+    )
+
+    anchor_script = _non_ascii_ratio(anchor)
+    language = pc.and_(
+        pc.less_equal(pc.abs(pc.subtract(anchor_script, _non_ascii_ratio(positive))), CONFIG["max_script_drift"]),
+        pc.less_equal(pc.abs(pc.subtract(anchor_script, _non_ascii_ratio(negative))), CONFIG["max_script_drift"]),
+    )
+    if "lang_code" in batch.schema.names:
+        base_lang = pc.list_element(pc.split_pattern(batch.column("lang_code"), "_"), 0)
+        expects_non_latin = pc.is_in(base_lang, value_set=pa.array(sorted(NON_LATIN_LANGS)))
+        language = pc.and_(language, pc.equal(expects_non_latin, pc.greater(anchor_script, 0.3)))
+
+    negative_differs = pc.and_(
+        pc.not_equal(negative, anchor),
+        pc.not_equal(batch.column("negative_rdf"), batch.column("anchor_rdf")),
+    )
+
+    anchor_rdf_ok = _looks_like_turtle(batch.column("anchor_rdf"))
+    negative_rdf_ok = _looks_like_turtle(batch.column("negative_rdf"))
+    if parse_rdf:
+        # Rows of one entity share their anchor RDF, so each distinct document is parsed only once
+        anchor_rdf_ok = _parseable_values(batch.column("anchor_rdf"), anchor_rdf_ok)
+        negative_rdf_ok = _parseable_values(batch.column("negative_rdf"), negative_rdf_ok)
+    rdf_parseable = pc.and_(anchor_rdf_ok, negative_rdf_ok)
+
+    masks = {"text_length": text_length, "language": language, "negative_differs": negative_differs, "rdf_parseable": rdf_parseable}
+    masks = {name: pc.fill_null(mask, False) for name, mask in masks.items()}
+    passed = {name: pc.sum(mask).as_py() or 0 for name, mask in masks.items()}
+
+    keep = masks["text_length"]
+    for name in CHECKS[1:]:
+        keep = pc.and_(keep, masks[name])
+    passed["all"] = pc.sum(keep).as_py() or 0
+
+    scored = batch.append_column("data_quality_score", quality_score(batch))
+    return passed, batch.num_rows, scored.filter(keep)
+
+
+def _validate_task(batch, parse_rdf):
+    return validate_batch(batch, parse_rdf)
+
+
+def iter_input_batches(parquet_path: str | None, batch_size: int, lang_code: str | None = None):
+    """Yields record batches from local Parquet files, or from the generated Iceberg table.
+
+    With `lang_code`, only that language's rows are read; on the Iceberg table the filter prunes
+    whole partitions, so the other languages' data files are never opened.
+    """
+    if parquet_path:
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+        lang_filter = pc.field("lang_code") == lang_code if lang_code else None
+        yield from ds.dataset(parquet_path, format="parquet").to_batches(batch_size=batch_size, filter=lang_filter)
+        return
+    from pyiceberg.expressions import AlwaysTrue, EqualTo
+    from generate_dataset_from_uris import CONFIG as GENERATION_CONFIG, load_glue_catalog
+    catalog = load_glue_catalog(GENERATION_CONFIG["s3_warehouse"])
+    iceberg_table = catalog.load_table(GENERATION_CONFIG["iceberg_table_name"])
+    row_filter = EqualTo("lang_code", lang_code) if lang_code else AlwaysTrue()
+    yield from iceberg_table.scan(row_filter=row_filter).to_arrow_batch_reader()
+
+
+def run_validation(batches, output_path: str | None, workers: int, parse_rdf: bool = False) -> dict:
+    """Validates all batches across `workers` processes, keeping at most 2 batches per worker in flight."""
+    import pyarrow.parquet as pq
+    totals = {name: 0 for name in CHECKS + ("all",)}
+    rows = 0
+    writer = None
+
+    def collect(result):
+        nonlocal rows, writer
+        passed, batch_rows, filtered = result
+        rows += batch_rows
+        for name, count in passed.items():
+            totals[name] += count
+        if output_path and filtered.num_rows:
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, filtered.schema)
+            writer.write_batch(filtered)
+
+    try:
+        if workers <= 1:
+            for batch in batches:
+                collect(validate_batch(batch, parse_rdf))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                in_flight = deque()
+                for batch in batches:
+                    in_flight.append(pool.submit(_validate_task, batch, parse_rdf))
+                    if len(in_flight) >= 2 * workers:
+                        collect(in_flight.popleft().result())
+                while in_flight:
+                    collect(in_flight.popleft().result())
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return {"rows": rows, "pass_rates": {name: (count / rows if rows else 0.0) for name, count in totals.items()}, "passed": totals}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Validate a generated triplet dataset with vectorized quality checks.")
+    parser.add_argument("--parquet", type=str, default=None, help="Validate local Parquet file(s) or a directory instead of the Iceberg table.")
+    parser.add_argument("--output", type=str, default=None, help="Write rows passing every check (plus data_quality_score) to this Parquet file.")
+    parser.add_argument("--report", type=str, default=None, help="Also write the pass rates as JSON to this file.")
+    parser.add_argument("--lang", type=str, default=None, help="Only validate rows with this lang_code (e.g. 'de' or 'en_llm_assoc').")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes.")
+    parser.add_argument("--parse-rdf", action="store_true", help="Fully parse each distinct RDF document with rdflib, not only the structural check.")
+    args = parser.parse_args(argv)
+
+    print("--- Starting Dataset Validation ---")
+    report = run_validation(iter_input_batches(args.parquet, CONFIG["batch_size"], args.lang), args.output, args.workers, args.parse_rdf)
+
+    print(f"\n[INFO] Validated {report['rows']} rows.")
+    for name, rate in report["pass_rates"].items():
+        print(f"  {name:<18} {report['passed'][name]:>10}  {rate:7.2%}")
+    if args.output:
+        print(f"[SUCCESS] Filtered rows written to '{args.output}'.")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to '{args.report}'.")
+
+
+if __name__ == "__main__":
+    main()